@@ -0,0 +1,128 @@
+"""Write throughput and compression ratio of the export codecs
+
+Takes a sample chunk from an existing export file and writes every per-shot
+dataset of it with every codec of ExportWriters.codecs, into a scratch file
+in the given directory, i.e. on the file system the exports go to:
+    python CodecBenchmark.py amolr2516_r0123_000_000.h5 -n 500 -d /reg/d/...
+
+The codec of a dataset is then picked with the exporter's --dataset-codec.
+Throughput is that of writing the uncompressed bytes, including compression.
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+import h5py
+
+import ExportReaders
+import ExportWriters
+
+
+def SampleChunk(filename, nrows):
+    """The first nrows shots of the per-shot datasets of an export file
+
+    Of the SHESHits* columns (one row per hit) and of the sparse ITOF samples
+    the rows that belong to those shots are taken.
+    """
+    data = ExportReaders.Open(filename)
+    keys = list(data.keys())
+    hits = None
+    if 'SHESHitsShot' in keys:
+        hits = np.flatnonzero(np.ravel(data['SHESHitsShot']) < nrows)
+    if 'ITOFnnz' in keys:
+        nsamples = int(np.sum(np.ravel(data['ITOFnnz'])[:nrows], dtype=np.int64))
+    chunk = {}
+    for key in keys:
+        if key in ExportWriters.perfilekeys:
+            continue
+        value = data[key]
+        if len(value.shape) == 0 or value.shape[0] == 0:
+            continue
+        if hits is not None and key.startswith('SHESHits'):
+            chunk[key] = (ExportReaders.ReadRows(value, hits) if len(hits)
+                          else np.asarray(value[:0]))
+        elif key in ('ITOFIndex', 'ITOFValue'):
+            chunk[key] = np.asarray(value[:nsamples])
+        else:
+            chunk[key] = np.asarray(value[:nrows])
+    if hasattr(data, 'close'):
+        data.close()
+    return chunk
+
+
+def Benchmark(chunk, directory, chunkrows=100, repeat=3):
+    """Writes every dataset of chunk with every codec
+
+    Args:
+        chunk (dict): Dataset name -> array, e.g. from SampleChunk()
+        directory (str): Where the scratch file is written
+        chunkrows (int): HDF5 chunk size in rows, as the exporter's args.chunk
+        repeat (int): Writes per dataset and codec, the fastest one counts
+
+    Returns:
+        list of tuple: (dataset, codec, raw bytes, file bytes, seconds)
+    """
+    scratch = os.path.join(directory, 'codecbenchmark_{0}.h5'.format(
+        os.getpid()))
+    results = []
+    for key in sorted(chunk):
+        value = chunk[key]
+        for codec in sorted(ExportWriters.codecs):
+            best = np.inf
+            for i in range(repeat):
+                start = time.time()
+                with h5py.File(scratch, 'w') as h5:
+                    h5.create_dataset(
+                        key, data=value,
+                        chunks=(min(chunkrows, len(value)),) + value.shape[1:],
+                        **ExportWriters.codecs[codec])
+                # Count the time until the data is on disk, not in the cache
+                fd = os.open(scratch, os.O_RDONLY)
+                os.fsync(fd)
+                os.close(fd)
+                best = min(best, time.time() - start)
+            results.append((key, codec, value.nbytes,
+                            os.path.getsize(scratch), best))
+            os.remove(scratch)
+    return results
+
+
+def Report(results):
+    """Table of the results, plus the totals per codec"""
+    lines = ['{0:<16}{1:<14}{2:>10}{3:>10}{4:>8}{5:>10}'.format(
+        'dataset', 'codec', 'raw MB', 'file MB', 'ratio', 'MB/s')]
+    totals = {}
+    for key, codec, raw, size, seconds in results:
+        lines.append('{0:<16}{1:<14}{2:>10.2f}{3:>10.2f}{4:>8.2f}{5:>10.1f}'
+                     .format(key, codec, raw / 1e6, size / 1e6,
+                             float(raw) / size, raw / 1e6 / max(seconds, 1e-9)))
+        total = totals.setdefault(codec, [0, 0, 0.])
+        total[0] += raw
+        total[1] += size
+        total[2] += seconds
+    lines.append('')
+    for codec, (raw, size, seconds) in sorted(totals.items()):
+        lines.append('{0:<16}{1:<14}{2:>10.2f}{3:>10.2f}{4:>8.2f}{5:>10.1f}'
+                     .format('all', codec, raw / 1e6, size / 1e6,
+                             float(raw) / size, raw / 1e6 / max(seconds, 1e-9)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the export codecs on a sample chunk')
+    parser.add_argument('file', help='Export file (.h5 or .npz) to sample')
+    parser.add_argument('-n', '--rows', help='Shots in the sample chunk',
+                        type=int, default=500)
+    parser.add_argument('-d', '--directory',
+                        help='Where to write, default next to the sample file')
+    parser.add_argument('-c', '--chunk', help='HDF5 chunk size in shots',
+                        type=int, default=100)
+    parser.add_argument('-r', '--repeat', help='Writes per dataset and codec',
+                        type=int, default=3)
+    args = parser.parse_args()
+
+    directory = args.directory or os.path.dirname(os.path.abspath(args.file))
+    chunk = SampleChunk(args.file, args.rows)
+    print Report(Benchmark(chunk, directory, args.chunk, args.repeat))
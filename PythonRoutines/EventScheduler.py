@@ -0,0 +1,58 @@
+"""Dynamic distribution of events over MPI ranks
+
+Instead of every rank taking every size-th event of the run, rank 0 hands out
+batches of event indices to whichever worker asks for one next. Slow events
+(e.g. many UXS fits) then only hold back the rank that got them, not the end
+of the whole job. The workers read their events by index, which
+needs an indexed (':idx') psana DataSource.
+"""
+from mpi4py import MPI
+
+tag_request = 1
+tag_batch = 2
+
+
+def Serve(comm, events, batchsize):
+    """Master loop, run on rank 0
+
+    Hands out batches (lists) of the given event indices until all of them
+    are given out, then answers every further request with None so the
+    workers stop.
+
+    Args:
+        comm: MPI communicator, rank 0 is the master
+        events (sequence of int): Indices of the events to process, in order
+        batchsize (int): Events per batch
+
+    Returns:
+        dict: Number of batches handed to each worker rank
+    """
+    nworkers = comm.Get_size() - 1
+    status = MPI.Status()
+    nbatches = dict((worker, 0) for worker in range(1, nworkers + 1))
+    start = 0
+    stopped = 0
+    while stopped < nworkers:
+        comm.recv(source=MPI.ANY_SOURCE, tag=tag_request, status=status)
+        worker = status.Get_source()
+        if start < len(events):
+            stop = min(start + batchsize, len(events))
+            comm.send([int(i) for i in events[start:stop]], dest=worker,
+                      tag=tag_batch)
+            nbatches[worker] += 1
+            start = stop
+        else:
+            comm.send(None, dest=worker, tag=tag_batch)
+            stopped += 1
+    return nbatches
+
+
+def Batches(comm):
+    """Worker side: yields batches of event indices until the master says
+    stop"""
+    while True:
+        comm.send(None, dest=0, tag=tag_request)
+        batch = comm.recv(source=0, tag=tag_batch)
+        if batch is None:
+            return
+        yield batch
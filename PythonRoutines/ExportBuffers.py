@@ -0,0 +1,74 @@
+"""Growable staging buffers for XTCExporter
+
+The per-shot detector arrays have a fixed number of rows, but the number of
+SHES electron hits per shot varies. HitBuffer keeps them in NumPy columns that
+grow by doubling, so appending a shot never creates Python float objects.
+"""
+import numpy as np
+
+# Bits of the per-shot 'Valid' flags: which detectors delivered data
+validbits = {'EBeam': 1 << 0,
+             'SHES': 1 << 1,
+             'UXS': 1 << 2,
+             'ITOF': 1 << 3,
+             'GMD': 1 << 4,
+             'XTCAV': 1 << 5,
+             'Pressure': 1 << 6}
+
+
+class HitBuffer(object):
+    """Columnar store of SHES electron hits
+
+    Columns are x and y (float32), the event timestamp (int64) and the index
+    of the shot within the staged chunk (uint32).
+    """
+    columns = (('x', np.float32),
+               ('y', np.float32),
+               ('ts', np.int64),
+               ('shot', np.uint32))
+
+    def __init__(self, capacity=4096):
+        self.n = 0
+        for name, dtype in self.columns:
+            setattr(self, name, np.empty((capacity,), dtype=dtype))
+
+    def __len__(self):
+        return self.n
+
+    def _Grow(self, needed):
+        capacity = max(needed, 2 * len(self.x))
+        for name, dtype in self.columns:
+            old = getattr(self, name)
+            new = np.empty((capacity,), dtype=dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def Append(self, x, y, ts, shot):
+        """Adds the hits of one shot
+
+        Args:
+            x, y (array-like): Hit positions
+            ts (int): Event timestamp
+            shot (int): Index of the shot in the staged chunk
+        """
+        x = np.asarray(x, dtype=np.float32)
+        stop = self.n + len(x)
+        if stop > len(self.x):
+            self._Grow(stop)
+        self.x[self.n:stop] = x
+        self.y[self.n:stop] = np.asarray(y, dtype=np.float32)
+        self.ts[self.n:stop] = ts
+        self.shot[self.n:stop] = shot
+        self.n = stop
+
+    def Truncate(self, n):
+        """Drops every hit appended after the first n"""
+        self.n = min(n, self.n)
+
+    def Clear(self):
+        self.n = 0
+
+    def Columns(self):
+        """Copies of the filled part of every column, keyed by column name"""
+        return dict((name, getattr(self, name)[:self.n].copy())
+                    for name, dtype in self.columns)
@@ -0,0 +1,98 @@
+"""Chunk-level checkpoints of an export, so that a killed job can resume
+
+Every rank keeps a manifest (amolr2516_rXXXX_RRR_manifest.json, next to the
+export files) listing the files it has completed and the events that went
+into them. Events are recorded as inclusive [first, last] ranges with a
+stride, which is the number of ranks for the static nevent % size scheduling
+and 1 for dynamic scheduling. This way also the events that were read but
+dropped or rejected count as done.
+
+On restart with --resume the exporter reads the manifests of all ranks, skips
+every event that is already in a completed file and continues each rank's file
+numbering after its last completed file.
+"""
+import os
+import glob
+import json
+
+import numpy as np
+
+
+def ManifestName(directory, runnumber, rank):
+    return (directory + 'amolr2516_r' + str(runnumber).zfill(4) + '_' +
+            str(rank).zfill(3) + '_manifest.json')
+
+
+def ManifestFiles(directory, runnumber):
+    return sorted(glob.glob(directory + 'amolr2516_r' + str(runnumber).zfill(4) +
+                            '_[0-9][0-9][0-9]_manifest.json'))
+
+
+def LoadAll(directory, runnumber):
+    """Completed-file entries of all ranks
+
+    Returns:
+        list of dict: Entries with keys rank, file, filenum, stride, events
+    """
+    entries = []
+    for filename in ManifestFiles(directory, runnumber):
+        with open(filename) as f:
+            entries += json.load(f)
+    return entries
+
+
+def RemoveAll(directory, runnumber):
+    for filename in ManifestFiles(directory, runnumber):
+        os.remove(filename)
+
+
+def DoneEvents(entries):
+    """Boolean array over event numbers, True for events in completed files"""
+    last = max([-1] + [r[1] for e in entries for r in e['events']])
+    done = np.zeros((last + 1,), dtype=bool)
+    for entry in entries:
+        for first, last in entry['events']:
+            done[first:last + 1:entry['stride']] = True
+    return done
+
+
+def NextFileNum(entries, rank):
+    """File number a rank continues with after its completed files"""
+    return max([-1] + [e['filenum'] for e in entries if e['rank'] == rank]) + 1
+
+
+class Manifest(object):
+    """Manifest of one rank, rewritten every time a file is completed"""
+
+    def __init__(self, directory, runnumber, rank, stride, entries=None):
+        self.filename = ManifestName(directory, runnumber, rank)
+        self.rank = rank
+        self.stride = stride
+        self.entries = [e for e in (entries or []) if e['rank'] == rank]
+
+    def Done(self, filename, filenum, eventranges):
+        self.entries.append({'rank': self.rank,
+                             'file': os.path.basename(filename),
+                             'filenum': filenum,
+                             'stride': self.stride,
+                             'events': eventranges})
+        # Write-and-rename, so a crash never leaves half a manifest behind
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def RemoveIncomplete(filenames, entries):
+    """Deletes export files that are not listed as completed
+
+    These are the files a killed job was writing. They would otherwise stay
+    around (possibly corrupt) if their rank has nothing left to write.
+
+    Args:
+        filenames (list of str): Export files of the run
+        entries (list of dict): Manifest entries, see LoadAll()
+    """
+    completed = set(e['file'] for e in entries)
+    for filename in filenames:
+        if os.path.splitext(os.path.basename(filename))[0] not in completed:
+            os.remove(filename)
@@ -0,0 +1,105 @@
+"""Helpers for reading the files written by XTCExporter
+
+The functions take the loaded file, i.e. what np.load, scipy.io.loadmat or
+h5py.File returns, and hide the differences between the export modes.
+"""
+import numpy as np
+import scipy.io
+import h5py
+
+from ExportBuffers import validbits
+
+
+def Open(filename):
+    """Opens an export file according to its extension (.npz, .mat or .h5)"""
+    if filename.endswith('.h5'):
+        return h5py.File(filename, 'r')
+    if filename.endswith('.mat'):
+        return scipy.io.loadmat(filename)
+    return np.load(filename)
+
+
+def ReadRows(dataset, rows):
+    """Rows of a dataset, reading only those rows from HDF5 files"""
+    # h5py wants increasing, unique indices
+    unique, inverse = np.unique(rows, return_inverse=True)
+    return np.asarray(dataset[unique])[inverse]
+
+
+def ITOFTraces(data, shots=None):
+    """Dense ITOF traces of an export file
+
+    Works for files exported with a dense ITOF array as well as for files
+    exported with --itofmode sparse, in which case the traces are rebuilt from
+    the above-threshold samples. Shots without ITOF data come back as NaN,
+    as in the dense files. From HDF5 files only the requested shots are
+    read.
+
+    Args:
+        data: Loaded export file (npz, mat or HDF5)
+        shots (int or array, optional): Shots to return, all if None
+
+    Returns:
+        np.ndarray: Traces, shape (number of shots, ITOF samples)
+    """
+    if 'ITOF' in data:
+        if shots is None:
+            return np.asarray(data['ITOF'])
+        return ReadRows(data['ITOF'], np.atleast_1d(shots))
+
+    nnz = np.ravel(data['ITOFnnz']).astype(np.int64)
+    index = data['ITOFIndex']
+    value = data['ITOFValue']
+    iyield = np.ravel(data['ITOFYield'])
+    length = int(np.ravel(data['ITOFLength'])[0])
+    indptr = np.concatenate(([0], np.cumsum(nnz)))
+    # The HDF5 samples of selected shots are read shot by shot below, all
+    # others at once
+    if shots is None or not isinstance(index, h5py.Dataset):
+        index, value = np.ravel(index), np.ravel(value)
+    if shots is None:
+        shots = np.arange(len(nnz))
+    shots = np.atleast_1d(shots)
+
+    traces = np.zeros((len(shots), length), dtype=np.float32)
+    for i, shot in enumerate(shots):
+        start, stop = indptr[shot], indptr[shot + 1]
+        traces[i, index[start:stop]] = value[start:stop]
+    traces[np.isnan(iyield[shots]), :] = np.nan
+    return traces
+
+
+def SHESHits(data):
+    """SHES electron hits as the (N, 3) [x, y, timestamp] array of older files
+
+    Files exported with the columnar hit buffer store SHESHitsX, SHESHitsY,
+    SHESHitsTS and SHESHitsShot instead; the shot column is not part of the
+    returned array and can be read directly.
+    """
+    if 'SHESHits' in data:
+        return np.asarray(data['SHESHits'])
+    hits = np.zeros((len(np.ravel(data['SHESHitsX'])), 3))
+    hits[:, 0] = np.ravel(data['SHESHitsX'])
+    hits[:, 1] = np.ravel(data['SHESHitsY'])
+    hits[:, 2] = np.ravel(data['SHESHitsTS'])
+    return hits
+
+
+def ValidShots(data, *detectors):
+    """Shots for which all the given detectors delivered data
+
+    Only the 'Valid' flags are read, so this is cheap even for HDF5 files with
+    large detector arrays.
+
+    Args:
+        data: Loaded export file (npz, mat or HDF5)
+        *detectors (str): Keys of ExportBuffers.validbits, e.g. 'UXS', 'ITOF'
+
+    Returns:
+        np.ndarray: Boolean mask over the shots of the file
+    """
+    mask = 0
+    for detector in detectors:
+        mask |= validbits[detector]
+    valid = np.ravel(data['Valid'])
+    return (valid & mask) == mask
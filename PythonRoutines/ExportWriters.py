@@ -0,0 +1,306 @@
+"""Writers for the chunks of shots exported by XTCExporter
+
+Every writer is handed the dict of arrays built by XTCExporter.ChunkData() and
+takes care of putting it on disk, in one format only. NpzWriter writes one
+.npz file per chunk. HDF5Writer appends the chunks to extensible datasets, so
+the exporter only has to stage a few hundred shots in memory before handing
+them over. BackgroundWriter wraps either of them and does the writing in a
+separate thread. MATLAB files are made afterwards by MatConverter.py, for the
+runs that need them.
+
+Datasets can be compressed, each with its own codec (see codecs). Which codec
+pays off depends on the file system, CodecBenchmark.py measures it on a
+sample file.
+"""
+import io
+import os
+import time
+import Queue
+import threading
+import zipfile
+
+import numpy as np
+import h5py
+
+# Can be pointed elsewhere (e.g. for tests on a local machine) with the
+# AMOLR2516_RESULTS environment variable, which RunBatch.py --results sets
+resultsdir = os.path.join(
+    os.environ.get('AMOLR2516_RESULTS', '/reg/d/psdm/AMO/amolr2516/results'),
+    '')
+
+# Results sub-directory and file extension of every export format
+formats = {'npz': ('npzfiles', '.npz'),
+           'hdf5': ('h5files', '.h5')}
+
+# Entries of the chunk dict that describe the whole file rather than one shot
+perfilekeys = ('EnvVar', 'chicane_fs', 'ITOFLength', 'ITOFSamples')
+# Entries holding row numbers within the chunk, shifted to rows of the file
+rowindexkeys = ('SHESHitsShot',)
+# Entry with the event ranges read for the chunk. It is not written to the
+# file but passed on to the manifest once the file is complete
+progresskey = 'EventRanges'
+
+# Dataset codecs, as h5py create_dataset() options. 'zlib' is the only one
+# .npz files support. 'lzf' is a fast LZ codec that ships with h5py, shuffle
+# groups the bytes of the values, which helps for mostly-zero float arrays
+codecs = {'none': {},
+          'zlib': {'compression': 'gzip', 'compression_opts': 4},
+          'lzf': {'compression': 'lzf'},
+          'shuffle-zlib': {'compression': 'gzip', 'compression_opts': 4,
+                           'shuffle': True},
+          'shuffle-lzf': {'compression': 'lzf', 'shuffle': True}}
+npzcodecs = ('none', 'zlib')
+
+
+def RunDirectory(kind, runnumber, create=True):
+    """Returns (and creates if needed) the output directory of a run
+
+    Args:
+        kind (str): Sub-directory of the results, e.g. 'npzfiles'
+        runnumber (int): Run number
+        create (bool): Create the directory if it does not exist
+
+    Returns:
+        str: Directory path, with trailing slash
+    """
+    directory = (resultsdir + kind + '/run' + str(runnumber).zfill(4) + '/')
+    if create and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another rank got there first
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+def FileName(runnumber, rank, filenum):
+    """Base name (without extension) of a per-rank export file"""
+    return ('amolr2516_r' + str(runnumber).zfill(4) + '_' +
+            str(rank).zfill(3) + '_' + str(filenum).zfill(3))
+
+
+def CodecOf(datasetcodecs, key):
+    """Codec name of a dataset
+
+    Args:
+        datasetcodecs (dict): Dataset name -> codec name, the entry 'default'
+                              applies to all datasets not listed
+        key (str): Dataset name
+    """
+    datasetcodecs = datasetcodecs or {}
+    return datasetcodecs.get(key, datasetcodecs.get('default', 'none'))
+
+
+class NpzWriter(object):
+    """Writes every chunk as a .npz file"""
+
+    def __init__(self, runnumber, rank, filenum=0, manifest=None,
+                 datasetcodecs=None):
+        self.runnumber = runnumber
+        self.rank = rank
+        self.filenum = filenum
+        self.manifest = manifest
+        self.datasetcodecs = datasetcodecs
+        self.directory = RunDirectory('npzfiles', runnumber)
+
+    def _savez(self, filename, data):
+        # Like np.savez, but every array is deflated or stored on its own
+        with zipfile.ZipFile(filename, 'w', allowZip64=True) as zf:
+            for key, value in data.items():
+                buf = io.BytesIO()
+                np.lib.format.write_array(buf, np.asanyarray(value))
+                if CodecOf(self.datasetcodecs, key) == 'zlib':
+                    compress = zipfile.ZIP_DEFLATED
+                else:
+                    compress = zipfile.ZIP_STORED
+                zf.writestr(key + '.npy', buf.getvalue(),
+                            compress_type=compress)
+
+    def write(self, data):
+        eventranges = data.pop(progresskey, [])
+        filename = FileName(self.runnumber, self.rank, self.filenum)
+        if any(CodecOf(self.datasetcodecs, key) != 'none' for key in data):
+            self._savez(self.directory + filename + '.npz', data)
+        else:
+            np.savez(self.directory + filename, **data)
+        if self.manifest is not None:
+            self.manifest.Done(filename, self.filenum, eventranges)
+        self.filenum += 1
+
+    def close(self):
+        pass
+
+
+class HDF5Writer(object):
+    """Streams chunks into pre-sized, extensible HDF5 datasets
+
+    One file holds up to rowsperfile shots, after which the writer moves on to
+    the next file number. Datasets are created with rowsperfile rows, grown by
+    doubling when needed (electron hits are not one row per shot) and trimmed
+    to the filled length when the file is closed. Codecs are applied per
+    HDF5 chunk of chunkrows shots.
+
+    Chunks are written whole, so rowsperfile has to be a multiple of
+    chunkrows for the files not to grow past it.
+    """
+
+    def __init__(self, runnumber, rank, rowsperfile, chunkrows, filenum=0,
+                 manifest=None, datasetcodecs=None):
+        if rowsperfile % chunkrows != 0:
+            raise ValueError('{0} shots per file is not a multiple of the '
+                             'chunk of {1} shots'.format(rowsperfile,
+                                                         chunkrows))
+        self.runnumber = runnumber
+        self.rank = rank
+        self.rowsperfile = rowsperfile
+        self.chunkrows = chunkrows
+        self.filenum = filenum
+        self.manifest = manifest
+        self.datasetcodecs = datasetcodecs
+        self.directory = RunDirectory('h5files', runnumber)
+        self.h5 = None
+        self.filled = {}
+        self.rows = 0
+        self.eventranges = []
+
+    def _open(self, data):
+        filename = FileName(self.runnumber, self.rank, self.filenum)
+        self.h5 = h5py.File(self.directory + filename + '.h5', 'w')
+        self.filled = {}
+        self.rows = 0
+        for key in perfilekeys:
+            if key in data:
+                value = data[key]
+                self.h5[key] = np.nan if value is None else value
+
+    def _append(self, key, value):
+        if key not in self.h5:
+            self.h5.create_dataset(
+                key,
+                shape=(self.rowsperfile,) + value.shape[1:],
+                maxshape=(None,) + value.shape[1:],
+                chunks=(self.chunkrows,) + value.shape[1:],
+                dtype=value.dtype,
+                **codecs[CodecOf(self.datasetcodecs, key)])
+            self.filled[key] = 0
+        dset = self.h5[key]
+        start = self.filled[key]
+        stop = start + value.shape[0]
+        if stop > dset.shape[0]:
+            dset.resize(max(stop, 2 * dset.shape[0]), axis=0)
+        dset[start:stop] = value
+        self.filled[key] = stop
+
+    def write(self, data):
+        # Ranges of a chunk without shots go with the next file
+        self.eventranges += data.pop(progresskey, [])
+        nrows = len(data['TimeStamp'])
+        if nrows == 0 and self.h5 is None:
+            return
+        if self.h5 is None:
+            self._open(data)
+        for key, value in data.items():
+            if key in perfilekeys:
+                continue
+            if key in rowindexkeys:
+                value = np.asarray(value) + self.rows
+            self._append(key, np.asarray(value))
+        self.rows += nrows
+        if self.rows >= self.rowsperfile:
+            self.close()
+
+    def close(self):
+        if self.h5 is None:
+            return
+        for key, length in self.filled.items():
+            self.h5[key].resize(length, axis=0)
+        self.h5.close()
+        self.h5 = None
+        if self.manifest is not None:
+            self.manifest.Done(
+                FileName(self.runnumber, self.rank, self.filenum),
+                self.filenum, self.eventranges)
+        self.eventranges = []
+        self.filenum += 1
+
+
+class BackgroundWriter(object):
+    """Runs another writer in a thread behind a bounded queue
+
+    write() returns as soon as the chunk is queued, so the event loop only
+    blocks when maxqueue chunks are already waiting for the disk. Whatever is
+    passed as release together with a chunk is put on the free queue once the
+    chunk is on disk, which lets the caller recycle its staging arrays.
+
+    The time spent blocked on the queue and waiting for released buffers is
+    recorded, see Stats().
+    """
+
+    def __init__(self, writer, maxqueue=1):
+        self.writer = writer
+        self.queue = Queue.Queue(maxsize=maxqueue)
+        self.free = Queue.Queue()
+        self.error = None
+        self.nchunks = 0
+        self.maxdepth = 0
+        self.queuewait = 0.
+        self.bufferwait = 0.
+        self.writetime = 0.
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, release = item
+            start = time.time()
+            try:
+                self.writer.write(data)
+            except Exception as e:
+                self.error = e
+            self.writetime += time.time() - start
+            self.free.put(release)
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('background writer failed: {0}'.format(self.error))
+
+    def write(self, data, release=None):
+        self._check()
+        self.maxdepth = max(self.maxdepth, self.queue.qsize() + 1)
+        start = time.time()
+        self.queue.put((data, release))
+        self.queuewait += time.time() - start
+        self.nchunks += 1
+
+    def GetFree(self):
+        """Blocks until a chunk is on disk and returns its release object"""
+        start = time.time()
+        release = self.free.get()
+        self.bufferwait += time.time() - start
+        self._check()
+        return release
+
+    def Stats(self):
+        """Backpressure metrics
+
+        Returns:
+            dict: number of chunks, seconds spent writing in the thread,
+                  seconds the caller was blocked on the queue and on free
+                  buffers, and the largest queue depth seen
+        """
+        return {'chunks': self.nchunks,
+                'write_s': self.writetime,
+                'queue_wait_s': self.queuewait,
+                'buffer_wait_s': self.bufferwait,
+                'max_depth': self.maxdepth}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        self._check()
@@ -46,3 +46,17 @@ class ITOFDataPreProcessing():
 	self.FilterWaveform([0,500])
 	self.CalculateYield([0,500],3)
 	return self.iyield
+
+    def CropRebin(self, window, binsize, mode = 'sum'):
+	"""Keeps the samples window[0]:window[1] and combines every binsize of them
+	(sum or mean). The window has to be a whole number of bins long"""
+	wf = self.wf[window[0]:window[1]].reshape(-1, binsize)
+	if mode == 'mean':
+		self.wf = wf.mean(axis=1)
+	else:
+		self.wf = wf.sum(axis=1)
+
+    def SparseWaveform(self):
+	"""Above-threshold samples of the processed waveform as (indices, values)"""
+	idx = np.flatnonzero(self.wf).astype(np.int32)
+	return idx, self.wf[idx].astype(np.float32)
@@ -0,0 +1,89 @@
+"""Converts exported runs to MATLAB files
+
+The exporter only writes one format (HDF5 by default). This script makes the
+.mat files, in matfiles/runXXXX/, for the runs that actually need them:
+    python MatConverter.py 123 124 --format hdf5 -j 8
+
+Files are converted in parallel, one per process. The datasets of a file are
+read one at a time while scipy.io.savemat writes them, so a process never
+holds more than one dataset of a file in memory.
+"""
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+import scipy.io
+
+import ExportReaders
+import ExportWriters
+import RunIndex
+
+
+class _LazyItems(object):
+    """Hands the datasets of an open export file to savemat one at a time"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def items(self):
+        for key in self.data.keys():
+            yield key, np.asarray(self.data[key])
+
+
+def Convert(job):
+    """Writes one export file as .mat
+
+    Args:
+        job (tuple): (source file, target .mat file)
+
+    Returns:
+        str: The target file
+    """
+    source, target = job
+    data = ExportReaders.Open(source)
+    # Write under a temporary name so an interrupted conversion is redone
+    scipy.io.savemat(target + '.part', _LazyItems(data), appendmat=False)
+    if hasattr(data, 'close'):
+        data.close()
+    os.rename(target + '.part', target)
+    return target
+
+
+def Jobs(runnumber, fmt, force=False):
+    """(source, target) pairs of the files of a run still to be converted"""
+    kind, ext = ExportWriters.formats[fmt]
+    sources = RunIndex.RunFiles(ExportWriters.RunDirectory(kind, runnumber),
+                                runnumber, ext)
+    directory = ExportWriters.RunDirectory('matfiles', runnumber)
+    jobs = []
+    for source in sources:
+        target = (directory +
+                  os.path.splitext(os.path.basename(source))[0] + '.mat')
+        if force or not os.path.exists(target):
+            jobs.append((source, target))
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert exported runs to MATLAB files')
+    parser.add_argument('runs', help='Run numbers', type=int, nargs='+')
+    parser.add_argument('-f', '--format', help='Export format of the runs',
+                        choices=sorted(ExportWriters.formats), default='hdf5')
+    parser.add_argument('-j', '--processes', help='Parallel conversions',
+                        type=int, default=4)
+    parser.add_argument('--force', help='Also redo existing .mat files',
+                        action='store_true')
+    args = parser.parse_args()
+
+    jobs = []
+    for run in args.runs:
+        jobs += Jobs(run, args.format, args.force)
+    print 'Converting {0} files with {1} processes'.format(
+        len(jobs), args.processes)
+    pool = multiprocessing.Pool(args.processes)
+    for target in pool.imap_unordered(Convert, jobs):
+        print 'Written', target
+    pool.close()
+    pool.join()
@@ -0,0 +1,257 @@
+"""Events per second of the pre-processing stages, on one core
+
+Every stage runs on its own in a fresh process, on the same events, and
+reports the latency percentiles of its processing call (reading the event is
+not timed), its throughput and its peak memory:
+    python PipelineBenchmark.py -n 500                      # synthetic events
+    python PipelineBenchmark.py -n 500 --source replay=frames/
+    python PipelineBenchmark.py -n 500 --exprun exp=amolr2516:run=203
+
+Without --exprun the events come from SyntheticSource, with --source as its
+options (e.g. recorded frames to replay). A stage keeps up with the online
+rate (--rate, 120 Hz) if its throughput on one core is at least that rate.
+
+--save writes the results as JSON. Such a file given as --baseline is
+compared with, and the script exits with 1 if the mean or 99th percentile
+latency of a stage grew by more than --tolerance. A stage whose events all
+lack its data (e.g. xtcav on synthetic events, which have no XTCAV images)
+is reported as not measured and left out of the comparison.
+"""
+import sys
+import json
+import Queue
+import time
+import resource
+import argparse
+import itertools
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import SyntheticSource
+
+
+def SHESPreProcess(psana, ds):
+    import SHESPreProcessing
+    processor = SHESPreProcessing.SHESPreProcessor()
+    return (lambda evt: evt), processor.PreProcess
+
+
+def SHESOnlineProcess(psana, ds):
+    import SHESPreProcessing
+    processor = SHESPreProcessing.SHESPreProcessor()
+    return (lambda evt: evt), processor.OnlineProcess
+
+
+def UXSStandardAnalysis(psana, ds):
+    import UXSDataPreProcessing
+    det = psana.Detector('OPAL1')
+    processor = UXSDataPreProcessing.UXSDataPreProcessing()
+    return det.raw, processor.StandardAnalysis
+
+
+def ITOFStandardAnalysis(psana, ds):
+    import ITOFDataPreProcessing
+    det = psana.Detector('ACQ1')
+
+    def read(evt):
+        waveforms = det.waveform(evt)
+        return None if waveforms is None else waveforms[1]
+
+    def process(waveform):
+        return ITOFDataPreProcessing.ITOFDataPreProcessing(
+            waveform).StandardAnalysis()
+    return read, process
+
+
+def FindBlobs(psana, ds):
+    import matplotlib
+    matplotlib.use('Agg')
+    import find_blobs
+    det = psana.Detector('OPAL3')
+
+    def read(evt):
+        image = det.raw(evt)
+        return None if image is None else np.array(image)
+    return read, find_blobs.find_blobs
+
+
+def XTCavProcess(psana, ds):
+    import XTCAV_Processing
+    processor = XTCAV_Processing.XTCavProcessor()
+    processor.set_data_source(ds)
+
+    def read(evt):
+        # Events without an XTCAV image (all synthetic ones) are skipped
+        return evt if processor.set_event(evt) else None
+
+    def process(evt):
+        return processor.process()
+    return read, process
+
+
+# Stage name -> setup function, which returns (read, process). read(evt) gives
+# the input of process, or None for events without data, which are skipped.
+# A stage that skips all events is not measured
+stages = [('shes_preprocess', SHESPreProcess),
+          ('shes_online', SHESOnlineProcess),
+          ('uxs', UXSStandardAnalysis),
+          ('itof', ITOFStandardAnalysis),
+          ('find_blobs', FindBlobs),
+          ('xtcav', XTCavProcess)]
+
+
+def _MaxRSS():
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def Statistics(latencies, skipped, rssstart, rssend, rate):
+    """Summary of the per-event latencies (in s) of one stage"""
+    ms = 1e3 * np.array(latencies)
+    if len(ms) == 0:
+        ms = np.array([np.nan])
+    return {'events': len(latencies),
+            'skipped': skipped,
+            'mean_ms': float(np.mean(ms)),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(np.max(ms)),
+            'throughput_hz': len(latencies) / max(sum(latencies), 1e-9),
+            'over_budget': float(np.mean(ms > 1e3 / rate)),
+            'peak_rss_mb': rssend / 1024.,
+            'rss_growth_mb': (rssend - rssstart) / 1024.}
+
+
+def RunStage(name, args, queue):
+    """Runs one stage and puts (name, statistics, error) on the queue"""
+    try:
+        import psana
+        ds = psana.DataSource(args.exprun)
+        read, process = dict(stages)[name](psana, ds)
+        rssstart = _MaxRSS()
+        latencies = []
+        skipped = 0
+        events = itertools.islice(ds.events(), args.warmup + args.events)
+        for i, evt in enumerate(events):
+            data = read(evt)
+            if data is None:
+                skipped += 1
+                continue
+            start = time.time()
+            process(data)
+            if i >= args.warmup:
+                latencies.append(time.time() - start)
+        queue.put((name, Statistics(latencies, skipped, rssstart, _MaxRSS(),
+                                    args.rate), None))
+    except Exception:
+        queue.put((name, None, traceback.format_exc()))
+
+
+def Report(results, rate):
+    """Table of the stage statistics"""
+    lines = ['{0:<16}{1:>7}{2:>9}{3:>9}{4:>9}{5:>9}{6:>10}{7:>9}{8:>9}'
+             '  {9}'.format('stage', 'events', 'mean ms', 'p50 ms', 'p99 ms',
+                            'max ms', 'events/s', 'over', 'peak MB',
+                            '{0:g} Hz'.format(rate))]
+    for name, stats in results:
+        if 'error' in stats:
+            lines.append('{0:<16}failed: {1}'.format(
+                name, stats['error'].strip().splitlines()[-1]))
+            continue
+        if stats['events'] == 0:
+            lines.append('{0:<16}not measured, no events with data '
+                         '({1} skipped)'.format(name, stats['skipped']))
+            continue
+        lines.append(
+            '{0:<16}{1:>7}{2:>9.2f}{3:>9.2f}{4:>9.2f}{5:>9.2f}{6:>10.1f}'
+            '{7:>8.1f}%{8:>9.0f}  {9}'.format(
+                name, stats['events'], stats['mean_ms'], stats['p50_ms'],
+                stats['p99_ms'], stats['max_ms'], stats['throughput_hz'],
+                100 * stats['over_budget'], stats['peak_rss_mb'],
+                'ok' if stats['throughput_hz'] >= rate else 'TOO SLOW'))
+    return '\n'.join(lines)
+
+
+def Compare(results, baseline, tolerance):
+    """Stages whose mean or p99 latency grew by more than the tolerance
+
+    Stages that failed or were not measured, here or in the baseline, are
+    not compared.
+
+    Returns:
+        list of str: One line per regression
+    """
+    regressions = []
+    for name, stats in results:
+        reference = baseline.get(name, {})
+        if 'error' in stats or 'error' in reference or not reference:
+            continue
+        if stats['events'] == 0 or reference['events'] == 0:
+            continue
+        for key in ('mean_ms', 'p99_ms'):
+            if stats[key] > (1 + tolerance) * reference[key]:
+                regressions.append('{0} {1}: {2:.2f}, baseline {3:.2f}'.format(
+                    name, key, stats[key], reference[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pre-processing stages')
+    parser.add_argument('-n', '--events', help='Timed events per stage',
+                        type=int, default=200)
+    parser.add_argument('--warmup', help='Untimed events before those',
+                        type=int, default=5)
+    parser.add_argument('-s', '--stages', help='Stages to run, default all',
+                        nargs='+', choices=[name for name, setup in stages])
+    parser.add_argument('--exprun', help='Read this run with the real psana '
+                                         'instead of synthetic events')
+    parser.add_argument('--source', default='',
+                        help='SyntheticSource options, e.g. '
+                             'replay=frames/:hits=40')
+    parser.add_argument('--rate', help='Online rate per core to compare with',
+                        type=float, default=120.)
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with this results file')
+    parser.add_argument('--tolerance', help='Allowed relative slow-down',
+                        type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.exprun is None:
+        SyntheticSource.Install(args.source)
+        args.exprun = 'exp=amolr2516:run=0:events={0}'.format(
+            args.warmup + args.events)
+    names = args.stages or [name for name, setup in stages]
+
+    results = []
+    for name in names:
+        # A fresh process per stage, so its peak memory is its own
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=RunStage,
+                                          args=(name, args, queue))
+        process.start()
+        process.join()
+        try:
+            name, stats, error = queue.get(timeout=10)
+        except Queue.Empty:
+            stats, error = None, 'process exited with code {0}'.format(
+                process.exitcode)
+        results.append((name, stats if error is None else {'error': error}))
+    print Report(results, args.rate)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'exprun': args.exprun, 'source': args.source,
+                       'rate': args.rate, 'stages': dict(results)}, f,
+                      indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['stages']
+        regressions = Compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print 'REGRESSION', line
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,160 @@
+"""Exports a range of runs, skipping finished runs and retrying failed ones
+
+Replaces the bsub loop of preprocessdata_new.sh:
+    python RunBatch.py 100 120 -n 8 -j 3 --retries 2 -- --itofmode sparse
+
+Every run is one XTCExporter job, started with the launcher command (mpirun
+on the local machine by default, see preprocessdata_new.sh for the batch
+queue). Up to -j runs are exported at the same time, each with -n ranks.
+Arguments after -- are passed on to the exporter.
+
+A run counts as finished when its run index exists and is newer than all of
+its manifests, since the exporter builds the index only after every rank has
+closed its files. Failed runs are retried with --resume, which keeps the
+files the failed attempt completed. The output of every run goes to
+LOGDIR/runXXXX.log.
+"""
+import os
+import sys
+import shlex
+import argparse
+import subprocess
+import multiprocessing.pool
+
+import ExportManifest
+import ExportWriters
+import RunIndex
+
+exprun = 'exp=amolr2516:run={0}'
+
+
+def IndexFile(runnumber, fmt):
+    # Only looked at, so the run directory is not created
+    directory = ExportWriters.RunDirectory(ExportWriters.formats[fmt][0],
+                                           runnumber, create=False)
+    return RunIndex.IndexFileName(directory, runnumber)
+
+
+def RunComplete(runnumber, fmt):
+    """True if the export of a run got to the end"""
+    indexfile = IndexFile(runnumber, fmt)
+    if not os.path.exists(indexfile):
+        return False
+    built = os.path.getmtime(indexfile)
+    manifests = ExportManifest.ManifestFiles(os.path.dirname(indexfile) + '/',
+                                             runnumber)
+    return all(os.path.getmtime(m) <= built for m in manifests)
+
+
+def Command(args, runnumber, resume):
+    """Command line of the export of one run"""
+    command = shlex.split(args.launcher.format(ranks=args.ranks,
+                                               run=runnumber))
+    command += [args.python, args.exporter, exprun.format(runnumber),
+                '--format', args.format]
+    if resume:
+        command.append('--resume')
+    return command + args.exporterargs
+
+
+def Export(runnumber, args):
+    """Exports one run, retrying with --resume after a failure
+
+    Returns:
+        tuple: (run number, True if the run is complete, attempts made)
+    """
+    logname = os.path.join(args.logdir,
+                           'run' + str(runnumber).zfill(4) + '.log')
+    indexfile = IndexFile(runnumber, args.format)
+    for attempt in range(1, args.retries + 2):
+        # Only an export that gets to the end leaves an index behind
+        if os.path.exists(indexfile):
+            os.remove(indexfile)
+        command = Command(args, runnumber, args.resume or attempt > 1)
+        with open(logname, 'a') as log:
+            log.write('### Attempt {0}: {1}\n'.format(attempt,
+                                                      ' '.join(command)))
+            log.flush()
+            code = subprocess.call(command, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        if code == 0 and RunComplete(runnumber, args.format):
+            return runnumber, True, attempt
+    return runnumber, False, attempt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export a range of runs with XTCExporter.py, arguments '
+                    'after -- go to the exporter')
+    parser.add_argument('first', help='First run', type=int)
+    parser.add_argument('last', help='Last run (included)', type=int)
+    parser.add_argument('-n', '--ranks', help='MPI ranks per run', type=int,
+                        default=4)
+    parser.add_argument('-j', '--concurrent', help='Runs exported at once',
+                        type=int, default=2)
+    parser.add_argument('--retries', help='Retries of a failed run',
+                        type=int, default=1)
+    parser.add_argument('-f', '--format', help='Export format',
+                        choices=sorted(ExportWriters.formats), default='hdf5')
+    parser.add_argument('--force', help='Also export finished runs again',
+                        action='store_true')
+    parser.add_argument('--resume',
+                        help='Continue partial exports from the first attempt '
+                             'on, not only on retries',
+                        action='store_true')
+    parser.add_argument('--launcher',
+                        help='Command the exporter is started with, {ranks} '
+                             'and {run} are filled in. Empty for a plain, '
+                             'single rank python process',
+                        default='mpirun -n {ranks}')
+    parser.add_argument('--python', help='Python interpreter of the exporter',
+                        default=sys.executable)
+    parser.add_argument('--exporter', help='Export script',
+                        default=os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)),
+                            'XTCExporter.py'))
+    parser.add_argument('--logdir', help='Directory of the run logs',
+                        default='./Log_XTCExporter')
+    parser.add_argument('--results',
+                        help='Results directory instead of the experiment one')
+    argv = sys.argv[1:]
+    exporterargs = []
+    if '--' in argv:
+        exporterargs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.exporterargs = exporterargs
+
+    if args.results:
+        # Also seen by the exporters, which inherit the environment
+        os.environ['AMOLR2516_RESULTS'] = args.results
+        ExportWriters.resultsdir = os.path.join(args.results, '')
+    if not os.path.isdir(args.logdir):
+        os.makedirs(args.logdir)
+
+    runs = []
+    for run in range(args.first, args.last + 1):
+        if not args.force and RunComplete(run, args.format):
+            print 'Run {0} already exported, skipped'.format(run)
+        else:
+            runs.append(run)
+    print 'Exporting {0} runs, {1} at a time with {2} ranks each'.format(
+        len(runs), args.concurrent, args.ranks)
+
+    # Threads are enough, the work is done in the launched processes
+    pool = multiprocessing.pool.ThreadPool(args.concurrent)
+    failed = []
+    for run, complete, attempts in pool.imap_unordered(
+            lambda run: Export(run, args), runs):
+        if complete:
+            print 'Run {0} done ({1} attempts)'.format(run, attempts)
+        else:
+            print 'Run {0} FAILED after {1} attempts, see {2}'.format(
+                run, attempts, args.logdir)
+            failed.append(run)
+    pool.close()
+    pool.join()
+
+    if failed:
+        print 'Failed runs:', ' '.join(str(run) for run in sorted(failed))
+        sys.exit(1)
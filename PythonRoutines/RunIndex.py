@@ -0,0 +1,148 @@
+"""Run-level index over the per-rank export files
+
+XTCExporter writes one amolr2516_rXXXX_RRR_FFF file per rank and chunk, with
+the events of a run interleaved between the ranks. Build() reads only the
+TimeStamp column of every file of a run and writes a single index, sorted by
+time, that maps every shot to its file and row. RunIndex uses that index to
+fetch single shots or time ranges, opening only the files that hold them.
+
+The exporter builds the index at the end of every run. For older runs:
+    python RunIndex.py 123 --format hdf5
+"""
+import os
+import glob
+import argparse
+
+import numpy as np
+
+import ExportReaders
+import ExportWriters
+
+
+def IndexFileName(directory, runnumber):
+    return directory + 'amolr2516_r' + str(runnumber).zfill(4) + '_index.npz'
+
+
+def RunFiles(directory, runnumber, ext):
+    """Sorted per-rank export files of a run"""
+    pattern = (directory + 'amolr2516_r' + str(runnumber).zfill(4) +
+               '_[0-9][0-9][0-9]_[0-9][0-9][0-9]' + ext)
+    return sorted(glob.glob(pattern))
+
+
+def _Close(data):
+    if hasattr(data, 'close'):
+        data.close()
+
+
+def Build(runnumber, fmt='hdf5'):
+    """Writes the time-sorted index of a run
+
+    Args:
+        runnumber (int): Run number
+        fmt (str): Export format of the run, key of ExportWriters.formats
+
+    Returns:
+        str: Name of the index file
+    """
+    kind, ext = ExportWriters.formats[fmt]
+    directory = ExportWriters.RunDirectory(kind, runnumber)
+    files = RunFiles(directory, runnumber, ext)
+    stamps = [np.zeros((0,))]
+    fileidx = [np.zeros((0,), dtype=np.uint32)]
+    rows = [np.zeros((0,), dtype=np.uint32)]
+    for i, filename in enumerate(files):
+        data = ExportReaders.Open(filename)
+        timestamps = np.ravel(data['TimeStamp'])
+        _Close(data)
+        stamps.append(timestamps)
+        fileidx.append(np.ones(len(timestamps), dtype=np.uint32) * i)
+        rows.append(np.arange(len(timestamps), dtype=np.uint32))
+    stamps = np.concatenate(stamps)
+    order = np.argsort(stamps, kind='mergesort')
+
+    indexfile = IndexFileName(directory, runnumber)
+    np.savez(indexfile,
+             TimeStamp=stamps[order],
+             File=np.concatenate(fileidx)[order],
+             Row=np.concatenate(rows)[order],
+             Files=np.array([os.path.basename(f) for f in files]))
+    return indexfile
+
+
+class RunIndex(object):
+    """Time-ordered access to the shots of an exported run
+
+    Shots are addressed by their position in the time-sorted index, which
+    Range() and Find() return for timestamp ranges and exact timestamps.
+    """
+
+    def __init__(self, runnumber, fmt='hdf5'):
+        kind, ext = ExportWriters.formats[fmt]
+        self.directory = ExportWriters.RunDirectory(kind, runnumber)
+        index = np.load(IndexFileName(self.directory, runnumber))
+        self.timestamps = index['TimeStamp']
+        self.files = index['File']
+        self.rows = index['Row']
+        self.filenames = list(index['Files'])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def Range(self, start, stop):
+        """Positions of the shots with start <= TimeStamp < stop"""
+        first, last = np.searchsorted(self.timestamps, [start, stop])
+        return np.arange(first, last)
+
+    def Find(self, timestamps):
+        """Positions of the shots with exactly these timestamps, -1 if absent"""
+        timestamps = np.atleast_1d(timestamps)
+        if len(self.timestamps) == 0:
+            return -np.ones(len(timestamps), dtype=int)
+        positions = np.searchsorted(self.timestamps, timestamps)
+        positions = np.minimum(positions, len(self.timestamps) - 1)
+        positions[self.timestamps[positions] != timestamps] = -1
+        return positions
+
+    def Fetch(self, positions, keys):
+        """Reads per-shot datasets of the given shots
+
+        Only the files that hold them are opened, and from HDF5 files only
+        their rows are read.
+
+        Args:
+            positions (array): Positions in the index, e.g. from Range()
+            keys (list of str): Per-shot datasets, e.g. ['UXSpc', 'ITOF'].
+                                'ITOF' also works for sparse ITOF files.
+
+        Returns:
+            dict: Dataset name -> array with one row per requested position
+        """
+        positions = np.atleast_1d(positions)
+        files = self.files[positions]
+        out = {}
+        for fileidx in np.unique(files):
+            sel = np.flatnonzero(files == fileidx)
+            rows = self.rows[positions[sel]]
+            data = ExportReaders.Open(self.directory + self.filenames[fileidx])
+            for key in keys:
+                if key == 'ITOF':
+                    values = ExportReaders.ITOFTraces(data, rows)
+                else:
+                    values = ExportReaders.ReadRows(data[key], rows)
+                if key not in out:
+                    out[key] = np.empty((len(positions),) + values.shape[1:],
+                                        dtype=values.dtype)
+                out[key][sel] = values
+            _Close(data)
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the time-sorted index of an exported run')
+    parser.add_argument('run', help='Run number', type=int)
+    parser.add_argument('-f', '--format', help='Export format of the run',
+                        choices=sorted(ExportWriters.formats), default='hdf5')
+    args = parser.parse_args()
+    print 'Index written to', Build(args.run, args.format)
@@ -0,0 +1,164 @@
+"""Cheap per-stage timing of the event loop
+
+Every stage of an event (psana read, SHES pre-processing, UXS analysis, ...)
+adds its wall time to a fixed, log-spaced histogram, so the per-event cost is
+a couple of time.time() calls and a bisect. Histograms of all ranks are summed
+on rank 0 at the end of the run, which prints a summary table and can write
+the profile as JSON.
+
+Usage:
+    timer = StageTimer()
+    t = timer.Tic()
+    ...
+    t = timer.Toc('read', t)
+    ...
+    t = timer.Toc('process', t)
+"""
+import bisect
+import json
+import resource
+import time
+
+import numpy as np
+
+# Histogram bin edges in seconds, 10 bins per decade from 1 us to 100 s
+binedges = list(np.logspace(-6, 2, 81))
+
+
+class StageTimer(object):
+
+    def __init__(self, memory=False):
+        """
+        Args:
+            memory (bool): Also attribute growth of the peak resident memory
+                           to the stage during which it happened
+        """
+        self.memory = memory
+        self.stages = []
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+        self.rss = {}
+        self.lastrss = self._MaxRSS() if memory else 0
+
+    @staticmethod
+    def _MaxRSS():
+        # kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _NewStage(self, stage):
+        self.stages.append(stage)
+        self.counts[stage] = np.zeros(len(binedges) + 1, dtype=np.int64)
+        self.totals[stage] = 0.
+        self.maxima[stage] = 0.
+        self.rss[stage] = 0
+
+    @staticmethod
+    def Tic():
+        return time.time()
+
+    def Add(self, stage, seconds):
+        if stage not in self.counts:
+            self._NewStage(stage)
+        self.counts[stage][bisect.bisect(binedges, seconds)] += 1
+        self.totals[stage] += seconds
+        if seconds > self.maxima[stage]:
+            self.maxima[stage] = seconds
+        if self.memory:
+            rss = self._MaxRSS()
+            if rss > self.lastrss:
+                self.rss[stage] += rss - self.lastrss
+                self.lastrss = rss
+
+    def Toc(self, stage, start):
+        """Records the time since start for stage
+
+        Returns:
+            float: The current time, to be used as start of the next stage
+        """
+        now = time.time()
+        self.Add(stage, now - start)
+        return now
+
+    def Merge(self, other):
+        for stage in other.stages:
+            if stage not in self.counts:
+                self._NewStage(stage)
+            self.counts[stage] += other.counts[stage]
+            self.totals[stage] += other.totals[stage]
+            self.maxima[stage] = max(self.maxima[stage], other.maxima[stage])
+            self.rss[stage] += other.rss[stage]
+
+    def Reduce(self, comm, root=0):
+        """Sums the timers of all ranks
+
+        Returns:
+            StageTimer: The summed timer on root, None on the other ranks
+        """
+        gathered = comm.gather(self, root=root)
+        if comm.Get_rank() != root:
+            return None
+        total = StageTimer(self.memory)
+        for timer in gathered:
+            total.Merge(timer)
+        return total
+
+    def Percentile(self, stage, q):
+        """Time below which a fraction q of the calls of stage lie
+
+        Only resolved to the histogram bin (a factor 1.26), within which it
+        is interpolated logarithmically, and never more than the maximum.
+        """
+        counts = self.counts[stage]
+        cumulative = np.cumsum(counts)
+        target = q * cumulative[-1]
+        idx = min(np.searchsorted(cumulative, target), len(counts) - 1)
+        # Bin idx holds the calls from binedges[idx - 1] to binedges[idx]
+        low = binedges[max(idx - 1, 0)]
+        high = binedges[idx] if idx < len(binedges) else self.maxima[stage]
+        below = cumulative[idx - 1] if idx > 0 else 0
+        fraction = (target - below) / float(max(counts[idx], 1))
+        value = low * (max(high, low) / low) ** min(max(fraction, 0.), 1.)
+        return min(value, self.maxima[stage])
+
+    def Profile(self):
+        """Machine readable profile: dict of stage -> statistics"""
+        profile = {'binedges_s': binedges, 'stages': {}}
+        for stage in self.stages:
+            calls = int(self.counts[stage].sum())
+            profile['stages'][stage] = {
+                'calls': calls,
+                'total_s': self.totals[stage],
+                'mean_s': self.totals[stage] / max(calls, 1),
+                'p50_s': self.Percentile(stage, 0.5),
+                'p90_s': self.Percentile(stage, 0.9),
+                'p99_s': self.Percentile(stage, 0.99),
+                'max_s': self.maxima[stage],
+                'maxrss_growth_kb': self.rss[stage],
+                'histogram': self.counts[stage].tolist()}
+        return profile
+
+    def Summary(self):
+        """Table of the stages, percentiles (~) resolved to the histogram bins"""
+        alltotal = sum(self.totals.values()) or 1.
+        lines = ['{0:<14}{1:>10}{2:>11}{3:>10}{4:>10}{5:>10}{6:>10}{7:>8}'.format(
+            'stage', 'calls', 'total s', 'mean ms', '~p50 ms', '~p99 ms',
+            'max ms', 'share')]
+        for stage, stats in sorted(self.Profile()['stages'].items(),
+                                   key=lambda x: -x[1]['total_s']):
+            lines.append(
+                '{0:<14}{1:>10}{2:>11.2f}{3:>10.2f}{4:>10.2f}{5:>10.2f}'
+                '{6:>10.2f}{7:>7.1f}%'.format(
+                    stage, stats['calls'], stats['total_s'],
+                    1e3 * stats['mean_s'], 1e3 * stats['p50_s'],
+                    1e3 * stats['p99_s'], 1e3 * stats['max_s'],
+                    100 * stats['total_s'] / alltotal))
+        lines.append('~ to the histogram bin, 10 per decade')
+        return '\n'.join(lines)
+
+    def Save(self, filename):
+        """Writes the summary to filename + '.txt' and the profile as JSON"""
+        with open(filename + '.txt', 'w') as f:
+            f.write(self.Summary() + '\n')
+        with open(filename + '.json', 'w') as f:
+            json.dump(self.Profile(), f, indent=1)
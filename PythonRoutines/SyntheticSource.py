@@ -0,0 +1,590 @@
+"""Synthetic stand-in for psana, to run and benchmark the analysis off-site
+
+Install() puts this module in place of psana (and a minimal xtcav) before any
+of the analysis modules is imported, which then read generated events
+instead of XTC files:
+    import SyntheticSource
+    SyntheticSource.Install('events=2000:rate=120')
+    import XTCExporter
+
+XTCExporter does this itself when AMOLR2516_SOURCE is set (to the options,
+or just to 'synthetic'), so a whole batch can be exported on a laptop:
+    AMOLR2516_SOURCE=events=500 python RunBatch.py 1 4 --launcher '' \\
+        --results /tmp/lr25
+
+Every event has
+    OPAL1  UXS camera, 1024x1024 uint16: two Gaussian lines along the energy
+           axis, bent by the spectrometer curvature, on a dark level
+    OPAL3  SHES camera, 1024x1024 uint16: electron blobs on a noisy background
+    ACQ1   Acqiris, 4 channels x 40000 samples: negative going ion hits
+    EBeam, FEEGasDetEnergy and the EPICS PVs the exporter reads
+    EventId with timestamps and fiducials at the given repetition rate
+
+Camera frames and waveforms are generated once per run, for a pool of frames
+that is played in a loop, so reading an event costs next to nothing and the
+benchmarks only time the analysis. The scalars are drawn per event from a
+seed made of the run and event number, which makes every event the same no
+matter which rank reads it, or in which order.
+
+Options, colon separated key=value pairs (also accepted in the data source
+string):
+    events   events per run (default 1000)
+    rate     repetition rate of the timestamps in Hz (default 120)
+    hits     mean number of SHES blobs per frame (default 20)
+    pool     frames generated per detector (default 16)
+    drop     probability that a detector has no data in an event (default 0)
+    seed     random seed, combined with the run number (default 0)
+    replay   directory with frames recorded by 'python SyntheticSource.py
+             record', which are played instead of generated ones (detectors
+             without a recording are still generated)
+
+The UXS analysis gets the synthetic dark frame through UXSCalibration,
+unless AMOLR2516_UXSCALIB points to other constants.
+
+Recording needs the real psana, i.e. a machine at the facility:
+    python SyntheticSource.py record exp=amolr2516:run=203 frames/ -n 200
+"""
+import os
+import sys
+import types
+import tempfile
+import argparse
+
+import numpy as np
+
+__all__ = ['DataSource', 'Detector', 'EventId', 'Source', 'Camera',
+           'Acqiris']
+
+defaultoptions = {'events': 1000, 'rate': 120., 'hits': 20., 'pool': 16,
+                  'drop': 0., 'seed': 0, 'replay': None}
+
+# Detectors with frames or waveforms, and the shape of their data
+framedetectors = {'OPAL1': (1024, 1024), 'OPAL3': (1024, 1024),
+                  'ACQ1': (4, 40000)}
+
+# EPICS PVs as (mean, spread)
+pvs = {'AMO:LMP:VG:21:PRESS': (2.0e-6, 1.0e-7),
+       'SIOC:SYS0:ML01:AO901': (10., 0.),
+       'TCAV:BMP1:360:ADES': (0., 0.)}
+
+# psana sources of cameras read with evt.get(Camera.FrameV1, source)
+camerasources = {'DetInfo(SxrEndstation.0:Opal1000.1)': 'OPAL3'}
+
+ebeamparameters = ['damageMask', 'ebeamCharge', 'ebeamDumpCharge',
+                   'ebeamEnergyBC1', 'ebeamEnergyBC2', 'ebeamL3Energy',
+                   'ebeamLTU250', 'ebeamLTU450', 'ebeamLTUAngX',
+                   'ebeamLTUAngY', 'ebeamLTUPosX', 'ebeamLTUPosY',
+                   'ebeamPhotonEnergy', 'ebeamPkCurrBC1', 'ebeamPkCurrBC2',
+                   'ebeamUndAngX', 'ebeamUndAngY', 'ebeamUndPosX',
+                   'ebeamUndPosY', 'ebeamXTCAVAmpl', 'ebeamXTCAVPhase']
+
+# Start of the synthetic run 0, in seconds since the epoch (Nov 2017)
+starttime = 1511000000
+
+
+def ParseOptions(options):
+    """Options from a 'key=value:key=value' string, e.g. the AMOLR2516_SOURCE
+    variable or a psana data source string. Unknown keys are ignored, so
+    'exp=...:run=...' parts can be passed along"""
+    parsed = {}
+    for part in options.split(':'):
+        if '=' not in part:
+            continue
+        key, value = part.split('=', 1)
+        if key not in defaultoptions:
+            continue
+        if key == 'replay':
+            parsed[key] = value
+        else:
+            parsed[key] = type(defaultoptions[key])(value)
+    return parsed
+
+
+###############################################################################
+# Frames and waveforms
+
+
+def DarkFrame(shape=(1024, 1024)):
+    """Fixed dark level of the synthetic UXS camera, the same for every run"""
+    r = np.random.RandomState(117)
+    return 40. + 5. * r.rand(*shape) + 2. * r.rand(shape[1])[None, :]
+
+
+def UXSFrame(r, shape=(1024, 1024), curvature=1.2e-4, dark=None):
+    """UXS camera frame with one or two spectral lines
+
+    Every line is a Gaussian along the energy axis (columns) that shifts by
+    curvature * (row - centre)**2 columns, under a Gaussian envelope along
+    the rows.
+    """
+    if dark is None:
+        dark = DarkFrame(shape)
+    rows = np.arange(shape[0])[:, None] - shape[0] / 2.
+    cols = np.arange(shape[1])[None, :]
+    shift = curvature * rows ** 2
+    envelope = np.exp(-0.5 * (rows / 150.) ** 2)
+    frame = dark + r.normal(0., 4., shape)
+    for i in range(1 + (r.rand() < 0.7)):
+        position = r.uniform(0.3, 0.7) * shape[1]
+        sigma = r.uniform(6., 20.)
+        height = r.uniform(300., 1500.)
+        frame += height * envelope * np.exp(
+            -0.5 * ((cols - position - shift) / sigma) ** 2)
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+def SHESFrame(r, shape=(1024, 1024), hits=20.):
+    """SHES camera frame with a Poisson number of electron blobs
+
+    The blobs fall into the part of the phosphor that the perspective
+    transform of SHESPreProcessing keeps.
+    """
+    frame = 20. + r.normal(0., 5., shape)
+    nhits = r.poisson(hits)
+    ys = r.uniform(212, 700, nhits)
+    xs = r.uniform(131, 845, nhits)
+    heights = r.normal(1500., 400., nhits)
+    offsets = np.arange(-4, 5)
+    for y, x, height in zip(ys, xs, heights):
+        iy, ix = int(y), int(x)
+        dy = (iy + offsets - y)[:, None]
+        dx = (ix + offsets - x)[None, :]
+        frame[iy - 4:iy + 5, ix - 4:ix + 5] += height * np.exp(
+            -(dy ** 2 + dx ** 2) / (2 * 1.5 ** 2))
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+def ITOFWaveforms(r, shape=(4, 40000), massestocharge=(1, 2, 14, 16, 17, 18,
+                                                         28, 32)):
+    """Acqiris waveforms in volts, with ion hits at the flight times of the
+    given mass-to-charge ratios on every channel"""
+    kernel = np.exp(-0.5 * (np.arange(-12, 13) / 3.) ** 2)
+    waveforms = r.normal(0., 0.002, shape)
+    for channel in range(shape[0]):
+        hits = np.zeros(shape[1])
+        for mz in massestocharge:
+            n = r.poisson(5.)
+            times = r.normal(2000. + 3000. * np.sqrt(mz), 15., n).astype(int)
+            times = times[(times >= 0) & (times < shape[1])]
+            np.add.at(hits, times, -r.uniform(0.02, 0.08, len(times)))
+        waveforms[channel] += np.convolve(hits, kernel, mode='same')
+    return waveforms
+
+
+###############################################################################
+# psana types
+
+
+class EventTime(object):
+    """What psana run.times() returns and run.event() takes"""
+
+    def __init__(self, seconds, nanoseconds, fiducial, index):
+        self._seconds = seconds
+        self._nanoseconds = nanoseconds
+        self._fiducial = fiducial
+        self.index = index
+
+    def seconds(self):
+        return self._seconds
+
+    def nanoseconds(self):
+        return self._nanoseconds
+
+    def fiducial(self):
+        return self._fiducial
+
+    def time(self):
+        return (self._seconds << 32) | self._nanoseconds
+
+
+class EventId(object):
+
+    def __init__(self, eventtime, runnumber):
+        self.eventtime = eventtime
+        self.runnumber = runnumber
+
+    def time(self):
+        return (self.eventtime.seconds(), self.eventtime.nanoseconds())
+
+    def fiducials(self):
+        return self.eventtime.fiducial()
+
+    def idxtime(self):
+        return self.eventtime
+
+    def run(self):
+        return self.runnumber
+
+    def __str__(self):
+        return 'EventId(run={0}, time={1}, fiducials={2})'.format(
+            self.runnumber, self.time(), self.fiducials())
+
+
+class Source(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Camera(object):
+
+    class FrameV1(object):
+
+        def __init__(self, data):
+            self.data = data
+
+        def data16(self):
+            return self.data
+
+
+class Acqiris(object):
+
+    class Config(object):
+        """Acqiris configuration, as far as the exporter reads it"""
+
+        class _Vert(object):
+
+            def offset(self):
+                return 0.
+
+            def fullScale(self):
+                return 0.5
+
+        class _Horiz(object):
+
+            def sampInterval(self):
+                return 1e-9
+
+        def vert(self):
+            return [self._Vert() for i in range(4)]
+
+        def horiz(self):
+            return self._Horiz()
+
+
+class _Values(object):
+    """Data object with one accessor method per value, like psana's EBeam
+    and gas detector data"""
+
+    def __init__(self, values):
+        for name, value in values.items():
+            setattr(self, name, (lambda v: lambda: v)(value))
+
+
+class _ConfigStore(object):
+
+    def get(self, kind, source=None):
+        if kind is Acqiris.Config:
+            return Acqiris.Config()
+        return None
+
+
+class _Env(object):
+
+    def __init__(self, dsstring):
+        self.dsstring = dsstring
+
+    def configStore(self):
+        return _ConfigStore()
+
+    def jobName(self):
+        return self.dsstring
+
+
+###############################################################################
+# Events
+
+
+class _Generator(object):
+    """Makes the events of one run"""
+
+    def __init__(self, runnumber, options):
+        self.runnumber = runnumber
+        self.options = options
+        self.pools = {}
+
+    def Pool(self, name):
+        """Frames of a detector, generated (or loaded) on first use"""
+        if name not in self.pools:
+            replay = self.options['replay']
+            if replay is not None and os.path.exists(
+                    os.path.join(replay, name + '.npy')):
+                pool = np.load(os.path.join(replay, name + '.npy'),
+                               mmap_mode='r')
+            else:
+                r = np.random.RandomState(
+                    [self.options['seed'], self.runnumber, len(name)])
+                shape = framedetectors[name]
+                if name == 'OPAL1':
+                    dark = DarkFrame(shape)
+                    frames = [UXSFrame(r, shape, dark=dark)
+                              for i in range(self.options['pool'])]
+                elif name == 'OPAL3':
+                    frames = [SHESFrame(r, shape, self.options['hits'])
+                              for i in range(self.options['pool'])]
+                else:
+                    frames = [ITOFWaveforms(r, shape)
+                              for i in range(self.options['pool'])]
+                pool = np.array(frames)
+                # psana hands out read-only arrays as well
+                pool.flags.writeable = False
+            self.pools[name] = pool
+        return self.pools[name]
+
+    def Time(self, index):
+        t = starttime + 3600 * self.runnumber + index / self.options['rate']
+        seconds = int(t)
+        return EventTime(seconds, int(round((t - seconds) * 1e9)),
+                         int(index * 360 / self.options['rate']) % 131040,
+                         index)
+
+    def Event(self, index):
+        return _Event(self, index)
+
+
+class _Event(object):
+
+    def __init__(self, generator, index):
+        self.generator = generator
+        self.index = index
+        self.eventid = EventId(generator.Time(index), generator.runnumber)
+        r = np.random.RandomState(
+            [generator.options['seed'], generator.runnumber, index])
+        names = sorted(framedetectors) + ['EBeam', 'FEEGasDetEnergy'] + \
+            sorted(pvs)
+        drop = r.rand(len(names)) < generator.options['drop']
+        self.missing = set(n for n, d in zip(names, drop) if d)
+        self.frame = index
+        gmd = r.gamma(4., 0.25)
+        self.gmd = _Values(dict(
+            ('f_{0}_ENRC'.format(n), gmd * r.normal(1., 0.05))
+            for n in (11, 12, 21, 22, 63, 64)))
+        values = dict((name, r.normal(1., 0.01)) for name in ebeamparameters)
+        values['damageMask'] = 0
+        values['ebeamL3Energy'] = r.normal(3350., 5.)
+        values['ebeamPhotonEnergy'] = r.normal(530., 1.)
+        values['ebeamCharge'] = r.normal(0.18, 0.005)
+        self.ebeam = _Values(values)
+        self.pvs = dict((name, mean + spread * r.randn())
+                        for name, (mean, spread) in pvs.items())
+
+    def Data(self, name):
+        if name in self.missing:
+            return None
+        if name in framedetectors:
+            pool = self.generator.Pool(name)
+            return pool[self.frame % len(pool)]
+        if name == 'EBeam':
+            return self.ebeam
+        if name == 'FEEGasDetEnergy':
+            return self.gmd
+        return self.pvs[name]
+
+    def get(self, kind, source=None):
+        if kind is EventId:
+            return self.eventid
+        if kind is Camera.FrameV1 and source is not None:
+            name = camerasources.get(source.name)
+            if name is not None and self.Data(name) is not None:
+                return Camera.FrameV1(np.asarray(self.Data(name)))
+        return None
+
+    def run(self):
+        return self.generator.runnumber
+
+
+class _Run(object):
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def times(self):
+        return [self.generator.Time(i)
+                for i in range(self.generator.options['events'])]
+
+    def event(self, eventtime):
+        return self.generator.Event(eventtime.index)
+
+    def events(self):
+        for i in range(self.generator.options['events']):
+            yield self.generator.Event(i)
+
+    def run(self):
+        return self.generator.runnumber
+
+
+class DataSource(object):
+    """Stand-in for psana.DataSource
+
+    Takes the usual data source string, of which only the run number is
+    used, plus options (see the module docstring) in the string itself or as
+    keyword arguments. Both override the options given to Install().
+    """
+
+    def __init__(self, dsstring, **options):
+        self.dsstring = dsstring
+        parts = dict(p.split('=', 1) for p in dsstring.split(':') if '=' in p)
+        self.options = dict(defaultoptions)
+        self.options.update(installedoptions)
+        self.options.update(ParseOptions(dsstring))
+        self.options.update(options)
+        self.generator = _Generator(int(parts.get('run', 0)), self.options)
+
+    def events(self):
+        return _Run(self.generator).events()
+
+    def runs(self):
+        yield _Run(self.generator)
+
+    def env(self):
+        return _Env(self.dsstring)
+
+
+class Detector(object):
+    """Stand-in for psana.Detector, for the detectors and PVs listed above"""
+
+    def __init__(self, name):
+        if (name not in framedetectors and name not in pvs and
+                name not in ('EBeam', 'FEEGasDetEnergy')):
+            raise KeyError(name)
+        self.name = name
+
+    def raw(self, evt):
+        return evt.Data(self.name)
+
+    def calib(self, evt):
+        data = evt.Data(self.name)
+        return None if data is None else data.astype(np.float64)
+
+    image = calib
+
+    def waveform(self, evt):
+        return evt.Data(self.name)
+
+    def wftime(self, evt):
+        data = evt.Data(self.name)
+        if data is None:
+            return None
+        return np.tile(np.arange(data.shape[1]) * 1e-9, (data.shape[0], 1))
+
+    def get(self, evt):
+        return evt.Data(self.name)
+
+    def __call__(self, evt):
+        return evt.Data(self.name)
+
+
+class ShotToShotCharacterization(object):
+    """xtcav stand-in: the synthetic events carry no XTCAV images, so every
+    event is reported as not analysable"""
+
+    def SetEnv(self, env):
+        pass
+
+    def SetCurrentEvent(self, evt):
+        return False
+
+
+###############################################################################
+
+# Options given to Install(), defaults of every DataSource
+installedoptions = {}
+
+
+def Install(options=''):
+    """Makes 'import psana' and 'import xtcav' load the synthetic source
+
+    Has to run before the analysis modules are imported.
+
+    Args:
+        options (str): Options as in the module docstring, e.g. 'events=500'
+    """
+    installedoptions.clear()
+    installedoptions.update(ParseOptions(options))
+    module = sys.modules[__name__]
+    sys.modules['psana'] = module
+    s2s = types.ModuleType('xtcav.ShotToShotCharacterization')
+    s2s.ShotToShotCharacterization = ShotToShotCharacterization
+    # The exporter gets psana.Acqiris through the xtcav star import
+    s2s.psana = module
+    xtcav = types.ModuleType('xtcav')
+    xtcav.ShotToShotCharacterization = s2s
+    sys.modules['xtcav'] = xtcav
+    sys.modules['xtcav.ShotToShotCharacterization'] = s2s
+    if 'AMOLR2516_UXSCALIB' not in os.environ:
+        InstallCalibration(os.path.join(tempfile.gettempdir(),
+                                        'amolr2516_synthetic_calib'))
+
+
+def InstallCalibration(directory):
+    """Points UXSCalibration (also in child processes) to a directory with
+    the synthetic dark frame, valid for all runs"""
+    darkdir = os.path.join(directory, 'darkframe')
+    if not os.path.exists(os.path.join(darkdir, '0-end.npy')):
+        if not os.path.isdir(darkdir):
+            try:
+                os.makedirs(darkdir)
+            except OSError:
+                # Another process got there first
+                if not os.path.isdir(darkdir):
+                    raise
+        # Written under another name first, other processes may be reading
+        tmpname = os.path.join(darkdir, 'tmp{0}.npy'.format(os.getpid()))
+        np.save(tmpname, DarkFrame())
+        os.rename(tmpname, os.path.join(darkdir, '0-end.npy'))
+    os.environ['AMOLR2516_UXSCALIB'] = directory
+    import UXSCalibration
+    UXSCalibration.calibdir = os.path.join(directory, '')
+
+
+def Record(dsstring, directory, nframes):
+    """Writes the frames of the first nframes events of a real run, for
+    replay=directory. Needs the real psana"""
+    import psana
+    ds = psana.DataSource(dsstring)
+    detectors = dict((name, psana.Detector(name)) for name in framedetectors)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = {}
+    for name, shape in framedetectors.items():
+        files[name] = np.lib.format.open_memmap(
+            os.path.join(directory, name + '.npy'), mode='w+',
+            dtype=np.uint16 if name.startswith('OPAL') else np.float64,
+            shape=(nframes,) + shape)
+    filled = dict((name, 0) for name in framedetectors)
+    for evt in ds.events():
+        for name, det in detectors.items():
+            if filled[name] == nframes:
+                continue
+            if name == 'ACQ1':
+                data = det.waveform(evt)
+            else:
+                data = det.raw(evt)
+            if data is not None:
+                files[name][filled[name]] = data
+                filled[name] += 1
+        if min(filled.values()) == nframes:
+            break
+    for name in framedetectors:
+        files[name].flush()
+        if filled[name] < nframes:
+            print 'Only {0} {1} frames in {2}'.format(filled[name], name,
+                                                      dsstring)
+            frames = np.array(files[name][:filled[name]])
+            del files[name]
+            np.save(os.path.join(directory, name + '.npy'), frames)
+    return filled
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Record frames of a real run for replay by the synthetic '
+                    'data source')
+    parser.add_argument('command', choices=['record'])
+    parser.add_argument('exprun', help='psana data source string, e.g. '
+                                       'exp=amolr2516:run=203')
+    parser.add_argument('directory', help='Where to write the frames')
+    parser.add_argument('-n', '--frames', help='Frames per detector',
+                        type=int, default=100)
+    args = parser.parse_args()
+    print 'Recorded', Record(args.exprun, args.directory, args.frames)
@@ -0,0 +1,152 @@
+"""Calibration constants of the UXS spectrometer, loaded once per process
+
+Every kind of constant (dark frame, energy scale, curvature xshifts) is kept
+as .npy files in calibdir/<kind>/, one per validity range of runs, named
+like the psana calibration files: <first>-<last>.npy, 'end' for an open
+range. For a run the file with the latest first run that still covers it is
+used. The files are memory mapped read-only and cached, so all
+UXSDataPreProcessing instances of a process, and the processes of a node
+through the page cache, share one copy.
+
+Kinds without a file for the run fall back to the defaults: energy scale in
+pixels and no curvature. The dark frame falls back to the pickle of run 117
+that UXSDataPreProcessing used to load.
+
+New constants are deployed with
+    python UXSCalibration.py darkframe DarkFramerun117.p 117
+    python UXSCalibration.py xshifts 0.out.accimage_CURV 150 203
+taking .npy files, pickles with a 'MeanDark' entry, or the JSON lists that
+UXSAlignment.saveXshifts writes.
+"""
+import os
+import re
+import glob
+import json
+import pickle
+import argparse
+
+import numpy as np
+
+# Can be pointed elsewhere (e.g. for tests off-site) with AMOLR2516_UXSCALIB
+calibdir = os.path.join(
+    os.environ.get('AMOLR2516_UXSCALIB',
+                   '/reg/d/psdm/amo/amolr2516/calib/UXS'), '')
+
+kinds = ('darkframe', 'energyscale', 'xshifts')
+
+# Dark frame used before the constants had validity ranges
+legacydark = 'DarkFramerun117.p'
+
+# Energy calibration as [Channel, Energy], see EnergyScale()
+energycalibrationpoints = np.array([[522, 522],
+                                    [570, 513],
+                                    [287.15, 535.4]])
+
+# Loaded constants, by file name
+_cache = {}
+
+
+def EnergyScale(points=energycalibrationpoints, npixels=1024, order=1):
+    """Energy of every pixel from a polyfit of [Channel, Energy] points"""
+    energypoly = np.polyfit(points[:, 0], points[:, 1], order)
+    return np.polyval(energypoly, np.arange(npixels))
+
+
+def _ReadOnly(array):
+    array.flags.writeable = False
+    return array
+
+
+def _Defaults(kind):
+    if kind == 'energyscale':
+        # Todo deploy EnergyScale() once the calibration points are final
+        return _ReadOnly(np.arange(0, 1024))
+    if kind == 'xshifts':
+        # No curvature
+        return _ReadOnly(np.zeros(1024, dtype=int))
+    with open(calibdir + legacydark, 'rb') as f:
+        return _ReadOnly(np.asarray(pickle.load(f)['MeanDark']))
+
+
+def ValidityRanges(kind):
+    """(first, last, filename) of the files of a kind, last None for 'end'"""
+    ranges = []
+    for filename in glob.glob(calibdir + kind + '/*.npy'):
+        match = re.match(r'(\d+)-(\d+|end)\.npy$', os.path.basename(filename))
+        if match is None:
+            continue
+        first, last = match.groups()
+        ranges.append((int(first), None if last == 'end' else int(last),
+                       filename))
+    return sorted(ranges)
+
+
+def FileFor(kind, run=None):
+    """The file of a kind valid for run, the latest one if run is None"""
+    candidates = [(first, filename)
+                  for first, last, filename in ValidityRanges(kind)
+                  if run is None or
+                  (first <= run and (last is None or run <= last))]
+    if not candidates:
+        return None
+    return max(candidates)[1]
+
+
+def Get(kind, run=None):
+    """Read-only constants of a kind valid for run (see FileFor())"""
+    filename = FileFor(kind, run)
+    key = filename or 'default ' + kind
+    if key not in _cache:
+        if filename is None:
+            _cache[key] = _Defaults(kind)
+        else:
+            _cache[key] = np.load(filename, mmap_mode='r')
+    return _cache[key]
+
+
+def Load(run=None):
+    """All constants valid for run, as a dict kind -> array"""
+    return dict((kind, Get(kind, run)) for kind in kinds)
+
+
+def Deploy(kind, source, first, last=None):
+    """Writes constants read from source for the runs first to last
+
+    Args:
+        kind (str): One of kinds
+        source (str): .npy file, pickle with 'MeanDark', or JSON list
+        first (int): First valid run
+        last (int): Last valid run, None for an open range
+
+    Returns:
+        str: The written file
+    """
+    if source.endswith('.npy'):
+        values = np.load(source)
+    elif source.endswith('.p') or source.endswith('.pkl'):
+        with open(source, 'rb') as f:
+            values = pickle.load(f)['MeanDark']
+    else:
+        with open(source) as f:
+            values = json.load(f)
+    values = np.asarray(values, dtype=int if kind == 'xshifts' else float)
+    directory = calibdir + kind + '/'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = '{0}{1}-{2}.npy'.format(directory, first,
+                                       'end' if last is None else last)
+    np.save(filename, values)
+    return filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Deploy UXS calibration constants for a range of runs')
+    parser.add_argument('kind', choices=kinds)
+    parser.add_argument('source', help='.npy file, pickle with MeanDark, or '
+                                       'JSON list (xshifts)')
+    parser.add_argument('first', help='First valid run', type=int)
+    parser.add_argument('last', help='Last valid run, open-ended if omitted',
+                        type=int, nargs='?')
+    args = parser.parse_args()
+    print 'Written', Deploy(args.kind, args.source, args.first, args.last)
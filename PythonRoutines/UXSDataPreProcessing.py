@@ -1,10 +1,10 @@
 import warnings
 
 import numpy as np
-import scipy.optimize
 import scipy.ndimage
 
-import pickle
+import UXSCalibration
+import UXSPeakFit
 
 warnings.filterwarnings('ignore',category=UserWarning,module='UXS')
 
@@ -13,52 +13,83 @@ class UXSDataPreProcessing:
     This class contains all the methods used for analysing the UXSData
     both for the online processing and for the preprocessing.
     """
-    def __init__(self):
-        # Hardcoded curvature correction
-        self.xshifts = [0]*1024 # Start with no curvature
-        #self.xshifts = [-328, -327, -326, -325, -324, -323, -322, -322, -321, -320, -319, -318, -317, -317, -316, -315, -314, -313, -312, -312, -311, -310, -309, -308, -307, -307, -306, -305, -304, -303, -302, -302, -301, -300, -299, -298, -297, -297, -296, -295, -294, -293, -293, -292, -291, -290, -289, -288, -288, -287, -286, -285, -284, -284, -283, -282, -281, -280, -280, -279, -278, -277, -276, -276, -275, -274, -273, -272, -272, -271, -270, -269, -268, -268, -267, -266, -265, -264, -264, -263, -262, -261, -261, -260, -259, -258, -257, -257, -256, -255, -254, -254, -253, -252, -251, -250, -250, -249, -248, -247, -247, -246, -245, -244, -244, -243, -242, -241, -240, -240, -239, -238, -237, -237, -236, -235, -234, -234, -233, -232, -231, -231, -230, -229, -228, -228, -227, -226, -225, -225, -224, -223, -222, -222, -221, -220, -219, -219, -218, -217, -216, -216, -215, -214, -214, -213, -212, -211, -211, -210, -209, -208, -208, -207, -206, -206, -205, -204, -203, -203, -202, -201, -200, -200, -199, -198, -198, -197, -196, -195, -195, -194, -193, -193, -192, -191, -191, -190, -189, -188, -188, -187, -186, -186, -185, -184, -183, -183, -182, -181, -181, -180, -179, -179, -178, -177, -177, -176, -175, -174, -174, -173, -172, -172, -171, -170, -170, -169, -168, -168, -167, -166, -166, -165, -164, -164, -163, -162, -162, -161, -160, -160, -159, -158, -158, -157, -156, -156, -155, -154, -154, -153, -152, -152, -151, -150, -150, -149, -148, -148, -147, -146, -146, -145, -144, -144, -143, -142, -142, -141, -140, -140, -139, -139, -138, -137, -137, -136, -135, -135, -134, -133, -133, -132, -132, -131, -130, -130, -129, -128, -128, -127, -126, -126, -125, -125, -124, -123, -123, -122, -121, -121, -120, -120, -119, -118, -118, -117, -117, -116, -115, -115, -114, -113, -113, -112, -112, -111, -110, -110, -109, -109, -108, -107, -107, -106, -106, -105, -104, -104, -103, -103, -102, -101, -101, -100, -100, -99, -98, -98, -97, -97, -96, -96, -95, -94, -94, -93, -93, -92, -91, -91, -90, -90, -89, -89, -88, -87, -87, -86, -86, -85, -85, -84, -83, -83, -82, -82, -81, -81, -80, -79, -79, -78, -78, -77, -77, -76, -76, -75, -74, -74, -73, -73, -72, -72, -71, -71, -70, -69, -69, -68, -68, -67, -67, -66, -66, -65, -65, -64, -63, -63, -62, -62, -61, -61, -60, -60, -59, -59, -58, -58, -57, -57, -56, -55, -55, -54, -54, -53, -53, -52, -52, -51, -51, -50, -50, -49, -49, -48, -48, -47, -47, -46, -46, -45, -45, -44, -44, -43, -43, -42, -42, -41, -41, -40, -40, -39, -39, -38, -38, -37, -37, -36, -36, -35, -35, -34, -34, -33, -33, -32, -32, -31, -31, -30, -30, -29, -29, -28, -28, -27, -27, -26, -26, -25, -25, -24, -24, -23, -23, -23, -22, -22, -21, -21, -20, -20, -19, -19, -18, -18, -17, -17, -16, -16, -16, -15, -15, -14, -14, -13, -13, -12, -12, -11, -11, -11, -10, -10, -9, -9, -8, -8, -7, -7, -6, -6, -6, -5, -5, -4, -4, -3, -3, -3, -2, -2, -1, -1, 0, 0, 0, 0, 0, 1, 1, 2, 2, 2, 3, 3, 4, 4, 5, 5, 5, 6, 6, 7, 7, 8, 8, 8, 9, 9, 10, 10, 10, 11, 11, 12, 12, 12, 13, 13, 14, 14, 14, 15, 15, 16, 16, 16, 17, 17, 18, 18, 18, 19, 19, 20, 20, 20, 21, 21, 22, 22, 22, 23, 23, 23, 24, 24, 25, 25, 25, 26, 26, 27, 27, 27, 28, 28, 28, 29, 29, 29, 30, 30, 31, 31, 31, 32, 32, 32, 33, 33, 33, 34, 34, 35, 35, 35, 36, 36, 36, 37, 37, 37, 38, 38, 38, 39, 39, 39, 40, 40, 41, 41, 41, 42, 42, 42, 43, 43, 43, 44, 44, 44, 45, 45, 45, 46, 46, 46, 47, 47, 47, 48, 48, 48, 49, 49, 49, 50, 50, 50, 50, 51, 51, 51, 52, 52, 52, 53, 53, 53, 54, 54, 54, 55, 55, 55, 55, 56, 56, 56, 57, 57, 57, 58, 58, 58, 58, 59, 59, 59, 60, 60, 60, 61, 61, 61, 61, 62, 62, 62, 63, 63, 63, 63, 64, 64, 64, 65, 65, 65, 65, 66, 66, 66, 66, 67, 67, 67, 68, 68, 68, 68, 69, 69, 69, 69, 70, 70, 70, 71, 71, 71, 71, 72, 72, 72, 72, 73, 73, 73, 73, 74, 74, 74, 74, 75, 75, 75, 75, 76, 76, 76, 76, 77, 77, 77, 77, 78, 78, 78, 78, 78, 79, 79, 79, 79, 80, 80, 80, 80, 81, 81, 81, 81, 81, 82, 82, 82, 82, 83, 83, 83, 83, 83, 84, 84, 84, 84, 85, 85, 85, 85, 85, 86, 86, 86, 86, 86, 87, 87, 87, 87, 87, 88, 88, 88, 88, 88, 89, 89, 89, 89, 89, 90, 90, 90, 90, 90, 91, 91, 91, 91, 91, 92, 92, 92, 92, 92, 92, 93, 93, 93, 93, 93, 94, 94, 94, 94, 94, 94, 95, 95, 95, 95, 95, 95, 96, 96, 96, 96, 96, 96, 97, 97, 97, 97, 97, 97, 98, 98, 98, 98, 98, 98, 98, 99, 99, 99, 99, 99, 99, 99, 100, 100, 100, 100, 100, 100, 100, 101, 101, 101, 101, 101, 101, 101, 102, 102, 102, 102, 102, 102, 102, 102, 103, 103, 103, 103, 103, 103, 103, 103, 104, 104, 104, 104, 104, 104, 104, 104, 105, 105, 105, 105, 105, 105, 105, 105, 105, 106, 106, 106, 106, 106, 106, 106, 106, 106, 106, 107, 107, 107, 107, 107, 107, 107, 107, 107, 107, 107, 108, 108, 108, 108, 108, 108, 108, 108, 108, 108, 108, 109, 109, 109, 109, 109, 109, 109, 109, 109, 109, 109, 109, 109, 109, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 110, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 111, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112, 112]
-
-        # Hardcoded energy calibration
-        # Defined as [Channel, Energy]
-        energycalibrationpoints = np.array([[522, 522],
-                                            [570, 513],
-                                            [287.15, 535.4]])
-        # Create energy scale by polyfitting calibrationpoints
-        energypoly = np.polyfit(energycalibrationpoints[:,0], energycalibrationpoints[:,1], 1)
-        # Todo change to hardcoded
-        #self.energyscale = np.polyval(energypoly, np.arange(0,1024)) # TODO also cut the energy scale when defining range
-        self.energyscale = np.arange(0,1024)
-
-        # Load DarkFrame
-        with open('/reg/d/psdm/amo/amolr2516/calib/UXS/DarkFramerun117.p', 'rb') as f:
-            data = pickle.load(f)
-        self.darkframe = data['MeanDark']
+    # Compiled curvature corrections, see Geometry()
+    geometries = {}
+
+    def __init__(self, projectiononly=True, run=None, keepimage=False,
+                 signalrows=None, backgroundrows=((0,100),(900,1024)), dtype=np.float64,
+                 warmstart=None):
+        # Curvature correction on the projections only (see
+        # CorrectedProjection), or on the image itself before projecting
+        self.projectiononly = projectiononly
+        # Keep the thresholded image of the last StandardAnalysis in
+        # self.image (for monitoring), which takes an extra pass over it
+        self.keepimage = keepimage
+        # Rows (first, last) with the spectrum, None for all. Only these
+        # are filtered, dark removed and projected
+        self.signalrows = signalrows
+        # Row ranges without signal, for RudimentaryBackground
+        self.backgroundrows = backgroundrows
+        # Floating point type of the dark removed frames and the
+        # projections, float32 halves their memory traffic. Frames that are
+        # only thresholded and projected keep the camera's uint16
+        self.dtype = np.dtype(dtype)
+        # Dark frame, energy scale and curvature correction (xshifts per
+        # yline) valid for the run, shared read-only between all instances
+        # (the dark frame only in float64)
+        calibration = UXSCalibration.Load(run)
+        self.xshifts = calibration['xshifts']
+        self.energyscale = calibration['energyscale']
+        self.darkframe = calibration['darkframe']
+        if self.darkframe.dtype != self.dtype:
+            self.darkframe = self.darkframe.astype(self.dtype)
+
+        # Index map of the curvature correction, see CompileGeometry()
+        self.geometry = None
+        # Peaks are fitted within this many start widths of their centers
+        self.fitwindow = 5.
+        # With warmstart (the weight of the newest fit, e.g. 0.3) FitSpectrum
+        # starts from a running average of the earlier fits, see WarmStart()
+        self.warmstart = warmstart
+        self.runningfit = None
+        # Fits, warm started fits, fallbacks to the moment estimates and
+        # model evaluations of FitSpectrum, see FitStatistics()
+        self.fitcounts = {'fits': 0, 'warm': 0, 'fallbacks': 0, 'evaluations': 0}
 
 
     @staticmethod
-    def FilterImage(image, sigma=1, order=0, threshold=80):
+    def FilterImage(image, sigma=1, order=0, threshold=80, rows=None, out=None):
         """
         Gaussian filter and threshold for the image.
+        With rows=(first, last) only the rows first to last-1 are filtered
+        and returned. With out, an array of the shape of the image, they are
+        written into those rows of out instead, and out is returned (its
+        other rows are left alone), so nothing is allocated.
         """
+        first, last = rows if rows is not None else (0, len(image))
+        block = None if out is None else out[first:last]
         # Gaussian filter
-        image = scipy.ndimage.gaussian_filter(image, sigma=sigma, order=order)
+        block = scipy.ndimage.gaussian_filter(image[first:last], sigma=sigma, order=order,
+                                              output=block)
         
         # Threshold
-        idx = image[:,:] < threshold
-        image[idx] = 0
+        idx = block[:,:] < threshold
+        block[idx] = 0
     
         # Remove border
-        image[0,:] = 0
-        image[:,0] = 0
-        return image
+        if first == 0:
+            block[0,:] = 0
+        block[:,0] = 0
+        return block if out is None else out
 
     def MaskImage(self, xmin=0,xmax=1024,ymin=0,ymax=1024):
         """
-        Set everything outside region to 0
+        Set everything outside region to 0, in place
         """
-        maskedimage = np.zeros((1024,1024))
-        maskedimage[ymin:ymax,xmin:xmax] = self.image[ymin:ymax,xmin:xmax]
-        self.image = maskedimage
+        self.image[:ymin] = 0
+        self.image[ymax:] = 0
+        self.image[:,:xmin] = 0
+        self.image[:,xmax:] = 0
 
     def AddFakeImageSignal(self, center=200, curvature=200):
         """
@@ -74,19 +105,134 @@ class UXSDataPreProcessing:
         x,y = x[mask],y[mask]
         np.add.at(self.image, (1023-y,x), 1)
 
+    def CompileGeometry(self, shape=(1024,1024)):
+        """
+        Turn the xshifts into flat index maps: the pixel at raw position src
+        ends up at position dst of the corrected image, in column cols.
+        Pixels shifted out of the image are left out, the ones shifted in
+        stay 0. Recompiled by Geometry() whenever xshifts changes.
+        """
+        xshifts = np.array(self.xshifts[:shape[0]], dtype=int)
+        rows, cols = np.indices(shape)
+        srccols = cols - xshifts[:,None]
+        valid = (srccols >= 0) & (srccols < shape[1])
+        self.geometry = {'xshifts': xshifts,
+                         'shape': shape,
+                         'identity': not np.any(xshifts),
+                         'dst': np.flatnonzero(valid).astype(np.int32),
+                         'src': (rows*shape[1] + srccols)[valid].astype(np.int32),
+                         'cols': cols[valid].astype(np.int32)}
+        # The maps are ordered by destination, and a row stays a row, so
+        # every range of rows is a contiguous range of them
+        self.geometry['rowbounds'] = np.searchsorted(self.geometry['dst'],
+                                                     np.arange(shape[0]+1)*shape[1])
+        # Maps for row ranges, see RowGeometry()
+        self.geometry['rows'] = {}
+
+    def Geometry(self, shape):
+        """
+        The compiled curvature correction for images of this shape, shared
+        between the instances with the same xshifts
+        """
+        if (self.geometry is None or self.geometry['shape'] != shape or
+                not np.array_equal(self.geometry['xshifts'], self.xshifts[:shape[0]])):
+            key = (shape, np.array(self.xshifts[:shape[0]], dtype=int).tostring())
+            if key not in UXSDataPreProcessing.geometries:
+                self.CompileGeometry(shape)
+                UXSDataPreProcessing.geometries[key] = self.geometry
+            self.geometry = UXSDataPreProcessing.geometries[key]
+        return self.geometry
+
+    def RowGeometry(self, shape, firstrow=0):
+        """
+        The compiled curvature correction for the rows firstrow to
+        firstrow+shape[0] of the frames, with the index maps into those rows
+        only, so it can be applied to views of them
+        """
+        geometry = self.Geometry((firstrow+shape[0], shape[1]))
+        if firstrow == 0:
+            return geometry
+        if firstrow not in geometry['rows']:
+            low, high = geometry['rowbounds'][[firstrow, firstrow+shape[0]]]
+            offset = firstrow*shape[1]
+            geometry['rows'][firstrow] = {'identity': geometry['identity'],
+                                          'dst': geometry['dst'][low:high] - offset,
+                                          'src': geometry['src'][low:high] - offset,
+                                          'cols': geometry['cols'][low:high]}
+        return geometry['rows'][firstrow]
+
     def CorrectImageGeometry(self):
         """
-        Correct the curvature by using a known list of xshifts per yline
+        Correct the curvature by using a known list of xshifts per yline,
+        i.e. shift every line by its xshift, with one gather over the image
         """
-        for y, shift in zip(range(1024), self.xshifts):
-            # Do the shift for every y-line
-            self.image[y,:] = np.roll(self.image[y,:], shift)
-            # Remove pixels that has rolled outside the image
-            # If needed we could add padding, but this should be sufficient
-            if shift < 0:
-                self.image[y, shift:] = 0
-            if shift > 0:
-                self.image[y, 0:np.abs(shift)] = 0
+        geometry = self.Geometry(self.image.shape)
+        if geometry['identity']:
+            return
+        corrected = np.zeros_like(self.image)
+        corrected.ravel()[geometry['dst']] = np.ravel(self.image)[geometry['src']]
+        self.image = corrected
+
+    def CorrectedProjections(self, images, firstrow=0):
+        """
+        The projections of a stack of images (N, rows, columns), curvature
+        corrected as StandardAnalysis does it for single images. The images
+        can be the rows from firstrow on of the frames.
+        returns the projections (N, columns) of type dtype
+        """
+        geometry = self.RowGeometry(images.shape[1:], firstrow)
+        if geometry['identity']:
+            return np.sum(images, 1).astype(self.dtype)
+        flat = images.reshape(len(images), -1)
+        corrected = np.zeros_like(flat)
+        corrected[:, geometry['dst']] = flat[:, geometry['src']]
+        return np.sum(corrected.reshape(images.shape), 1).astype(self.dtype)
+
+    def CorrectedProjection(self, image, firstrow=0):
+        """
+        Projection of the curvature corrected image, straight from the
+        uncorrected image without making the corrected one. The image can be
+        the rows from firstrow on of the frame.
+        returns the projection of type dtype
+        """
+        geometry = self.RowGeometry(image.shape, firstrow)
+        if geometry['identity']:
+            return self.CalculateProjection(image).astype(self.dtype)
+        return np.bincount(geometry['cols'], weights=np.ravel(image)[geometry['src']],
+                           minlength=image.shape[1]).astype(self.dtype)
+
+    def FusedProjections(self, image, rows=None, darkthreshold=60, threshold=200, blockrows=64):
+        """
+        The three curvature corrected projections of StandardAnalysis (raw,
+        dark removed with darkthreshold, and thresholded at threshold) in one
+        pass over the image, blockrows rows at a time, so that no temporary
+        is larger than a block. rows=(first, last) restricts all three to
+        those rows.
+        returns raw, darkremoved, thresholded projections (of type dtype)
+        """
+        height, width = image.shape
+        first, last = rows if rows is not None else (0, height)
+        geometry = self.Geometry(image.shape)
+        bounds = geometry['rowbounds']
+        # Accumulated in float64, the blocks are summed in dtype
+        projections = np.zeros((3, width))
+        for start in range(first, last, blockrows):
+            stop = min(start+blockrows, last)
+            block = image[start:stop]
+            darkremoved = block - self.darkframe[start:stop]
+            darkremoved[darkremoved < darkthreshold] = 0
+            thresholded = block*(block >= threshold)
+            if geometry['identity']:
+                projections[0] += np.sum(block, 0)
+                projections[1] += np.sum(darkremoved, 0)
+                projections[2] += np.sum(thresholded, 0)
+                continue
+            src = geometry['src'][bounds[start]:bounds[stop]] - start*width
+            cols = geometry['cols'][bounds[start]:bounds[stop]]
+            for projection, values in zip(projections, (block, darkremoved, thresholded)):
+                projection += np.bincount(cols, weights=np.ravel(values)[src], minlength=width)
+        projections = projections.astype(self.dtype)
+        return projections[0], projections[1], projections[2]
 
     @staticmethod
     def CutToLength(wf, energyscale, rangelim):
@@ -148,15 +294,11 @@ class UXSDataPreProcessing:
         return p[0] * np.exp(-((x-p[1])/p[2])**2/2)
     
     @staticmethod
-    def GaussianFit(xvalues, data, height, mu, sigma, maxfev=800):
+    def GaussianFit(xvalues, data, height, mu, sigma, maxfev=800, window=None):
         """
-        Do a gaussian fit
+        Do a gaussian fit, within window sigmas around mu if window is given
         """
-        def error(p,x,y):
-            return UXSDataPreProcessing.Gaussian(p,x) - y
-        p0 = np.array([height, mu, sigma])
-        p1, success = scipy.optimize.leastsq(error, p0, args=(xvalues, data), maxfev=maxfev)
-        return p1
+        return UXSPeakFit.Fit(xvalues, data, [height, mu, sigma], window, maxfev)
 
     @staticmethod
     def DoubleGaussian(p, x):
@@ -166,15 +308,14 @@ class UXSDataPreProcessing:
         return p[0] * np.exp(-((x-p[1])/p[2])**2/2) + p[3] * np.exp(-((x-p[4])/p[5])**2/2)
  
     @staticmethod
-    def DoubleGaussianFit(xvalues, data, height1, mu1, sigma1, height2, mu2, sigma2, maxfev=800):
+    def DoubleGaussianFit(xvalues, data, height1, mu1, sigma1, height2, mu2, sigma2, maxfev=800,
+                          window=None):
         """
-        Do a double gaussian fit
+        Do a double gaussian fit, within window sigmas around both peaks if
+        window is given
         """
-        def error(p,x,y):
-            return UXSDataPreProcessing.DoubleGaussian(p,x) - y
-        p0 = np.array([height1, mu1, sigma1, height2, mu2, sigma2])
-        p1, success = scipy.optimize.leastsq(error, p0, args=(xvalues, data), maxfev=maxfev)
-        return p1
+        return UXSPeakFit.Fit(xvalues, data, [height1, mu1, sigma1, height2, mu2, sigma2],
+                              window, maxfev)
    
     @staticmethod
     def _FindNearestIdx(array,value):
@@ -192,40 +333,76 @@ class UXSDataPreProcessing:
         """
         return np.sum(energyscale*spectrum)/np.sum(spectrum)
 
+    @staticmethod
+    def PeakCandidates(energyscale, spectra, threshold=0.4):
+        """
+        All runs of a spectrum, or of every spectrum of a stack (N, points),
+        at or above threshold*max of that spectrum, in one pass: the runs
+        are cut at the threshold crossings and numbered by a cumulative sum
+        of the run starts, the moments summed per run with bincount.
+
+        Returns arrays with one entry per run, ordered by spectrum and
+        position: spectrum index, center of mass, sigma (second moment) and area
+        """
+        spectra = np.atleast_2d(spectra)
+        above = spectra >= np.max(spectra, 1)[:,None]*threshold
+        # Run starts, padded so that runs never continue into the next spectrum
+        padded = np.zeros((len(spectra), spectra.shape[1]+1), dtype=bool)
+        padded[:,1:] = above
+        starts = padded[:,1:] & ~padded[:,:-1]
+        runs = np.cumsum(starts.ravel())[above.ravel()] - 1
+        nruns = np.count_nonzero(starts)
+        rows = np.nonzero(starts)[0]
+        values = spectra[above]
+        energies = np.broadcast_to(energyscale, spectra.shape)[above]
+        areas = np.bincount(runs, weights=values, minlength=nruns)
+        centers = np.bincount(runs, weights=values*energies, minlength=nruns)/areas
+        variances = np.bincount(runs, weights=values*(energies-centers[runs])**2,
+                                minlength=nruns)/areas
+        return rows, centers, np.sqrt(variances), areas
+
     @staticmethod
     def DetectPeaks(energyscale, spectrum, threshold=0.4):
         """
         Try to estimate if we have one or more peaks by cutting through the spectrum
         at level of threshold+max(spectrum).
         
-        Returns list of peak centers
-        """
-        # Find and mask everything below threshold, then get the unmasked slices
-        idxsbelow, = np.where(spectrum < np.max(spectrum)*threshold)
-        mspectrum = np.ma.MaskedArray(spectrum)
-        mspectrum[idxsbelow] = np.ma.masked
-        slicesabove = np.ma.clump_unmasked(mspectrum)
-        # Get the spectra of these slices, and calculate the area under each
-        areas = [spectrum[areaslice] for areaslice in slicesabove]
-        # Determine shape ratio of different peak candidates
-        allpeakarea = np.sum(spectrum[~idxsbelow])
-        shaperatios = [np.sum(area)/allpeakarea for area in areas]
-        shaperatios = np.asarray(shaperatios)
-        ## Only keep the two most intense
-        idxtwobest = np.argsort(-shaperatios)[:2]
-        cof = []
-        sigmas = []
-        for i,idx in enumerate(idxtwobest):
-            center = UXSDataPreProcessing.CenterOfMass(energyscale[slicesabove[idx]], spectrum[slicesabove[idx]])
-            # Estimate variance using second moment
-            sigma = np.sqrt(UXSDataPreProcessing.CenterOfMass(
-                                             (energyscale[slicesabove[idx]]-center)**2, spectrum[slicesabove[idx]]))
-            cof.append(center)
-            sigmas.append(sigma)
-        return cof, sigmas
+        Returns list of peak centers and list of their sigmas, the most
+        intense first. For a stack of spectra (N, points) lists of those per
+        spectrum.
+        """
+        rows, centers, sigmas, areas = UXSDataPreProcessing.PeakCandidates(
+                                                    energyscale, spectrum, threshold)
+        ## Only keep the two most intense of every spectrum
+        order = np.lexsort((-areas, rows))
+        first = np.searchsorted(rows[order], rows[order])
+        best = order[np.arange(len(order)) - first < 2]
+        cof = [[] for i in range(len(np.atleast_2d(spectrum)))]
+        sigmaslist = [[] for i in range(len(cof))]
+        for row, center, sigma in zip(rows[best], centers[best], sigmas[best]):
+            cof[row].append(center)
+            sigmaslist[row].append(sigma)
+        if np.ndim(spectrum) == 1:
+            return cof[0], sigmaslist[0]
+        return cof, sigmaslist
 
     @staticmethod
-    def DoPeakFit(energyscale, data, peaks, sigmas):
+    def InitialGuess(energyscale, data, peaks, sigmas):
+        """
+        Start values [height1, pos1, sigma1(, height2, pos2, sigma2)] of the
+        fit from the peaks found by DetectPeaks, leaving out peaks outside
+        the energyscale. Empty if there is no peak left.
+        """
+        p0 = []
+        for peak, sigma in zip(peaks, sigmas):
+            # Todo change if energyscale is reverseproportional to pixel
+            if peak < energyscale[0] or peak > energyscale[-1]:
+                continue
+            p0 += [data[UXSDataPreProcessing._FindNearestIdx(energyscale, peak)], peak, sigma]
+        return p0
+
+    @staticmethod
+    def DoPeakFit(energyscale, data, peaks, sigmas, window=None):
         """
         peaks is list of centerpoints
         sigmas is a list of variane
@@ -233,27 +410,62 @@ class UXSDataPreProcessing:
         If one peak the do single gaussian, if two peaks then do sum of two gaussians
         returns height1, pos1, sigma1, height2, pos2, sigma2
         """
-        for peak, sigma in zip(peaks, sigmas)[:]:
-            # Todo change if energyscale is reverseproportional to pixel
-            if peak < energyscale[0] or peak > energyscale[-1]:
-                peaks.remove(peak)
-                sigmas.remove(sigma)
-        pos1 = pos2 = height1 = height2 = sigma1 = sigma2 = np.nan
-        if len(peaks) == 1:
-            # Fit single gaussain
-            pos1 = peaks[0]
-            sigma1 = sigmas[0]
-            pos1idx = UXSDataPreProcessing._FindNearestIdx(energyscale, pos1)
-            p = UXSDataPreProcessing.GaussianFit(energyscale, data, data[pos1idx], pos1, sigmas[0])
-            height1, pos1, sigma1 = p
-        elif len(peaks) == 2:
-            # Fit double Gaussian
-            pos1idx = UXSDataPreProcessing._FindNearestIdx(energyscale, peaks[0])
-            pos2idx = UXSDataPreProcessing._FindNearestIdx(energyscale, peaks[1])
-            p = UXSDataPreProcessing.DoubleGaussianFit(
-                            energyscale, data, data[pos1idx], peaks[0], sigmas[0], data[pos2idx], peaks[1], sigmas[1])
-            height1, pos1, sigma1, height2, pos2, sigma2 = p
-        return height1, pos1, np.abs(sigma1), height2, pos2, np.abs(sigma2)
+        p0 = UXSDataPreProcessing.InitialGuess(energyscale, data, peaks, sigmas)
+        return UXSDataPreProcessing.PeakFit(energyscale, data, p0, window)[0]
+
+    @staticmethod
+    def PeakFit(energyscale, data, p0, window=None, maxfev=800):
+        """
+        Single or double gaussian fit from the start values p0 (see
+        InitialGuess)
+        returns (height1, pos1, sigma1, height2, pos2, sigma2), the number of
+        model evaluations and whether the fit converged
+        """
+        p = [np.nan]*6
+        evaluations, converged = 0, False
+        if len(p0) in (3, 6):
+            p1, evaluations, converged = UXSPeakFit.Fit(energyscale, data, p0, window, maxfev,
+                                                        full_output=True)
+            p[:len(p1)] = p1
+        height1, pos1, sigma1, height2, pos2, sigma2 = p
+        return ((height1, pos1, np.abs(sigma1), height2, pos2, np.abs(sigma2)),
+                evaluations, converged)
+
+    def WarmStart(self, energyscale, data):
+        """
+        Start values of the fit from the running average of the earlier
+        fits: their positions and widths, with the heights of data there
+        """
+        p0 = []
+        pos, sigma = self.runningfit[0::3], self.runningfit[1::3]
+        for peakpos, peaksigma in zip(pos, sigma):
+            if not np.isnan(peakpos):
+                p0 += [data[self._FindNearestIdx(energyscale, peakpos)], peakpos, peaksigma]
+        return p0
+
+    def UpdateRunningFit(self, fitresults):
+        """
+        Adds fitresults [pos1, sigma1, int1, pos2, sigma2, int2] to the
+        running average, which restarts from them when the number of peaks
+        changes
+        """
+        fitresults = np.array(fitresults)
+        if np.all(np.isnan(fitresults)):
+            return
+        if (self.runningfit is None or
+                not np.array_equal(np.isnan(self.runningfit), np.isnan(fitresults))):
+            self.runningfit = fitresults
+        else:
+            self.runningfit = (1-self.warmstart)*self.runningfit + self.warmstart*fitresults
+
+    def FitStatistics(self):
+        """
+        Summary of the fit counts, with the mean model evaluations per fit
+        """
+        counts = self.fitcounts
+        return '{0} fits, {1} warm started, {2} fell back, {3:.1f} evaluations per fit'.format(
+            counts['fits'], counts['warm'], counts['fallbacks'],
+            counts['evaluations']/max(counts['fits'], 1.))
 
     @staticmethod
     def RemoveBadPeaks(height,pos,sigma):
@@ -269,14 +481,13 @@ class UXSDataPreProcessing:
         return height,pos,sigma
 
     @staticmethod
-    def RudimentaryBackground(image):
+    def RudimentaryBackground(image, rows=((0,100),(900,1024))):
         """
         Makes a rudimentary background estimation
-        based on last n rows of pixels
+        based on the rows of pixels in the (first, last) ranges rows
         """
-        bg = np.average(image[900:1024,:], axis=0)
-        bg = bg + np.average(image[0:100,:], axis=0)
-        bg = UXSDataPreProcessing.GaussianFilter(bg, 10)/2
+        bg = np.mean([np.average(image[first:last,:], axis=0) for first, last in rows], axis=0)
+        bg = UXSDataPreProcessing.GaussianFilter(bg, 10)
         return bg
 
     @staticmethod
@@ -306,29 +517,43 @@ class UXSDataPreProcessing:
         """
         This is the standard run that we do
         returns the fitresults as produced by FitToDoubleGaussian
+        With keepimage (or without projectiononly) self.image is left with
+        the thresholded, curvature corrected image the projections are made
+        of, 0 outside the signalrows
         """
-        # Fix the image
-        self.image = image.copy()
         energyscale = self.energyscale
-        #self.CorrectImageGeometry()
-        # Find a rudimentary background
-        # Todo get real dark frames
-        #bg = self.RudimentaryBackground(image)
-        # Set everything outside region to 0
-        #self.MaskImage(xmin=0, xmax=1024, ymin=400, ymax=600)
-        wf = self.CalculateProjection(self.image)
-        unfilteredwf = wf.copy()
-        
-        # Create spectrum with darkremoved and thresholded
-        darkremoved = self.RemoveDark(self.darkframe, image, threshold=60)
-        darkremovedspectrum = self.CalculateProjection(darkremoved)
+        first, last = self.signalrows or (0, len(image))
+        # Thresholds act pixel by pixel, so the curvature can as well be
+        # corrected when projecting, all projections in one pass
+        if self.projectiononly:
+            unfilteredwf, darkremovedspectrum, wf = self.FusedProjections(image, self.signalrows)
+            if self.keepimage:
+                self.image = np.zeros_like(image)
+                self.image[first:last] = image[first:last]*(image[first:last] >= 200)
+                self.CorrectImageGeometry()
+        else:
+            # Fix the image
+            self.image = image.copy()
+            self.CorrectImageGeometry()
+            # Find a rudimentary background
+            # Todo get real dark frames
+            #bg = self.RudimentaryBackground(image, self.backgroundrows)
+            # Set everything outside region to 0
+            #self.MaskImage(xmin=0, xmax=1024, ymin=400, ymax=600)
+            wf = self.CalculateProjection(self.image[first:last]).astype(self.dtype)
+            unfilteredwf = wf.copy()
 
-        # Thresholding the image
-        idx = self.image[:,:] < 200
-        self.image[idx] = 0
- 
-        #bg = self.RudimentaryBackground(image)
-        wf = self.CalculateProjection(self.image)
+            # Create spectrum with darkremoved and thresholded
+            darkremoved = self.RemoveDark(self.darkframe[first:last], image[first:last], threshold=60)
+            darkremovedspectrum = self.CorrectedProjection(darkremoved, first)
+
+            # Thresholding the image
+            idx = self.image[:,:] < 200
+            self.image[idx] = 0
+            self.MaskImage(ymin=first, ymax=last)
+
+            #bg = self.RudimentaryBackground(image, self.backgroundrows)
+            wf = self.CalculateProjection(self.image[first:last]).astype(self.dtype)
         # Cut to length
         #wf, energyscale = self.CutToLength(wf, self.energyscale, [10,400]) # Pixelvalues
        
@@ -343,21 +568,110 @@ class UXSDataPreProcessing:
         #wf = self.NoiseThreshold(wf, 3,1.5)
         wf = self.RemoveNegative(wf)
 
+        fitresults = self.FitSpectrum(energyscale, wf)
+        if returnmore:
+            # Also return filtered wf and cut energyscale for online plotting purposes
+            return fitresults, unfilteredwf, darkremovedspectrum, wf, energyscale
+        return fitresults, unfilteredwf, darkremovedspectrum
+
+    def FitSpectrum(self, energyscale, wf):
+        """
+        Peak finding and fitting of a filtered spectrum
+        returns [pos1, sigma1, int1, pos2, sigma2, int2]
+        """
         ## Peakfinding
         # Find peaks by method of moments above threshold
         peaks, sigmas =  self.DetectPeaks(energyscale, wf, threshold=0.25)
-        # Fit single or double gaussian peaks
-        height1, pos1, sigma1, height2, pos2, sigma2 = self.DoPeakFit(energyscale, wf, peaks, sigmas)
+        p0 = self.InitialGuess(energyscale, wf, peaks, sigmas)
+        self.fitcounts['fits'] += 1
+        fitresults = None
+        # Start from the earlier fits if they have as many peaks
+        if self.warmstart and self.runningfit is not None:
+            warm = self.WarmStart(energyscale, wf)
+            if len(p0) and len(warm) == len(p0):
+                fit, evaluations, converged = self.PeakFit(energyscale, wf, warm, self.fitwindow)
+                self.fitcounts['evaluations'] += evaluations
+                fitresults = self.FitResults(*fit)
+                # Fall back to the moment estimates if a peak got lost
+                if converged and np.sum(np.isnan(fitresults)) == 6 - len(p0):
+                    self.fitcounts['warm'] += 1
+                else:
+                    self.fitcounts['fallbacks'] += 1
+                    fitresults = None
+        if fitresults is None:
+            # Fit single or double gaussian peaks
+            fit, evaluations, converged = self.PeakFit(energyscale, wf, p0, self.fitwindow)
+            self.fitcounts['evaluations'] += evaluations
+            fitresults = self.FitResults(*fit)
+        if self.warmstart:
+            self.UpdateRunningFit(fitresults)
+        return fitresults
+
+    @staticmethod
+    def FitResults(height1, pos1, sigma1, height2, pos2, sigma2):
+        """
+        Removes bad peaks from the fitted parameters and sorts them
+        returns [pos1, sigma1, int1, pos2, sigma2, int2]
+        """
         # TODO integrate instead of just returning height
-        height1, pos1, sigma1 = self.RemoveBadPeaks(height1,pos1,sigma1)
-        height2, pos2, sigma2 = self.RemoveBadPeaks(height2,pos2,sigma2)
+        height1, pos1, sigma1 = UXSDataPreProcessing.RemoveBadPeaks(height1,pos1,sigma1)
+        height2, pos2, sigma2 = UXSDataPreProcessing.RemoveBadPeaks(height2,pos2,sigma2)
         int1 = height1
         int2 = height2
         # Sort peaks so that highest pixelvalue(lowest energy) is always first
         if not np.isnan(sigma1) and not np.isnan(sigma2):
             if pos2 > pos1: 
                 pos1, sigma1, int1, pos2, sigma2, int2 = pos2, sigma2, int2, pos1, sigma1, int1
+        return [pos1, sigma1, int1, pos2, sigma2, int2]
+
+    def FitSpectra(self, energyscale, wfs):
+        """
+        FitSpectrum for a stack of filtered spectra. The spectra with one
+        and with two peaks are each fitted together (UXSPeakFit.FitBatch),
+        the ones that do not converge that way one by one.
+        returns an array with one row [pos1, sigma1, int1, pos2, sigma2, int2]
+        per spectrum
+        """
+        wfs = np.asarray(wfs)
+        fits = np.nan*np.ones((len(wfs), 6))
+        peaks, sigmas = self.DetectPeaks(energyscale, wfs, threshold=0.25)
+        p0s = [self.InitialGuess(energyscale, wf, wfpeaks, wfsigmas)
+               for wf, wfpeaks, wfsigmas in zip(wfs, peaks, sigmas)]
+        for npars in (3, 6):
+            idx = np.array([i for i, p0 in enumerate(p0s) if len(p0) == npars], dtype=int)
+            if len(idx) == 0:
+                continue
+            p, converged = UXSPeakFit.FitBatch(energyscale, wfs[idx], [p0s[i] for i in idx],
+                                               window=self.fitwindow)
+            for i in idx[~converged]:
+                p[idx == i] = UXSPeakFit.Fit(energyscale, wfs[i], p0s[i], self.fitwindow)
+            fits[idx, :npars] = p
+        fits[:, 2::3] = np.abs(fits[:, 2::3])
+        return np.array([self.FitResults(*fit) for fit in fits])
+
+    def StandardAnalysisBatch(self, images, returnmore=False):
+        """
+        StandardAnalysis for a stack of frames of shape (N, 1024, 1024), with
+        the same results up to the fit tolerance. The projections are made
+        frame by frame with FusedProjections, so no temporary is larger
+        than one of its row blocks. Smoothing and baseline removal are done
+        for all projections at once, and so are the peak fits (FitSpectra).
+        returns arrays with one row per frame: fitresults (N, 6), unfiltered
+        and dark removed projections, with returnmore also the filtered
+        projections and the energyscale
+        """
+        nframes, width = len(images), images[0].shape[1]
+        unfilteredwfs = np.zeros((nframes, width), dtype=self.dtype)
+        darkremovedspectra = np.zeros((nframes, width), dtype=self.dtype)
+        wfs = np.zeros((nframes, width), dtype=self.dtype)
+        for i, image in enumerate(images):
+            unfilteredwfs[i], darkremovedspectra[i], wfs[i] = self.FusedProjections(
+                                                                image, self.signalrows)
+        wfs = scipy.ndimage.gaussian_filter1d(wfs, 5, axis=1)
+        wfs -= np.mean(wfs[:,:10], axis=1)[:,None]
+        wfs[wfs < 0] = 0
+
+        fitresults = self.FitSpectra(self.energyscale, wfs)
         if returnmore:
-            # Also return filtered wf and cut energyscale for online plotting purposes
-            return [pos1, sigma1, int1, pos2, sigma2, int2], unfilteredwf, darkremovedspectrum, wf, energyscale
-        return [pos1, sigma1, int1, pos2, sigma2, int2], unfilteredwf, darkremovedspectrum
+            return fitresults, unfilteredwfs, darkremovedspectra, wfs, self.energyscale
+        return fitresults, unfilteredwfs, darkremovedspectra
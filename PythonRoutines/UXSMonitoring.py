@@ -78,6 +78,10 @@ histidx = 0
 # Keep the accumulated image
 accimage = np.zeros((1024,1024))
 
+# UXS analysis, loads the calibration once. Only the rows signalrows
+# (first, last) are analysed if given
+uxspre = UXSDataPreProcessing(keepimage=True, signalrows=None)
+
 start = time.time()
 print "Press enter to save data"
 for nevt, evt in enumerate(ds.events()):
@@ -101,7 +105,6 @@ for nevt, evt in enumerate(ds.events()):
     metadata[frameidx] = "Frame: {}, PhEn: {}, {}".format(frameidx, photonenergy, str(evt.get(EventId)))
     
     #opal_raw = np.rot90(opal_raw.copy()) # Do not rotate on LR25!
-    uxspre = UXSDataPreProcessing()
     #opal_raw = uxspre.FilterImage(opal_raw)
     [pos1, sigma1, int1, pos2, sigma2, int2], spectrum, darkremovespec, filtspec, cutenergyscale = uxspre.StandardAnalysis(opal_raw, True)
     energyscale = uxspre.energyscale
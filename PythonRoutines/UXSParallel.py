@@ -94,6 +94,11 @@ shotsperUXSUXS = np.zeros(nUXSUXSbins)
 thisPulseDistanceHistogram = np.zeros((1024,1024))
 shotpershotSeparation = np.zeros(1024)
 
+# UXS analysis, loads the calibration for the run once. Only the rows
+# signalrows (first, last), e.g. (480, 505), are filtered and analysed if given
+uxspre = UXSDataPreProcessing(run=int(runnr), signalrows=None)
+opalfiltered = None
+
 for nevent,evt in enumerate(ds.events()):
     if nevent%size!=rank:
         # Different ranks look at different events
@@ -120,13 +125,15 @@ for nevent,evt in enumerate(ds.events()):
     
     # Got the data
     opal = opal_raw
-    uxspre = UXSDataPreProcessing()
-    opal = uxspre.FilterImage(opal_raw)
-    #uxspre.MaskImage(xmin=0, xmax=1024, ymin=480, ymax=505)
+    # Filtered into the signal rows of one frame kept for all events
+    if opalfiltered is None:
+        opalfiltered = np.zeros(opal_raw.shape, dtype=uxspre.dtype)
+    opal = uxspre.FilterImage(opal_raw, rows=uxspre.signalrows, out=opalfiltered)
 
     # Divide image by Gas Detectors
     feeenergy = feedata.f_11_ENRC()/2+feedata.f_12_ENRC()/2
-    opal = opal/feeenergy
+    first, last = uxspre.signalrows or (0, len(opal))
+    opal[first:last] /= feeenergy
     [pos1, sigma1, int1, pos2, sigma2, int2], unfilteredwf, wf, energyscale = uxspre.StandardAnalysis(opal, returnmore=True)
     if np.isnan(pos1):
         continue
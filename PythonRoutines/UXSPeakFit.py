@@ -0,0 +1,154 @@
+"""Least-squares fits of one or two Gaussians to UXS spectra
+
+The model is the one of UXSDataPreProcessing.Gaussian/DoubleGaussian, with
+the parameters [height, mu, sigma] of every peak one after the other. The
+fits use the analytic Jacobian, and only the part of the spectrum within a
+few widths of the start values (Window()), which come from the moment
+estimates of UXSDataPreProcessing.DetectPeaks.
+
+Fit() fits one spectrum with scipy.optimize.leastsq. FitBatch() fits a
+stack of spectra at once, with a Levenberg-Marquardt iteration in which all
+spectra take their steps together.
+"""
+import numpy as np
+import scipy.optimize
+
+
+def Model(p, x):
+    """Sum of Gaussians, parameters on the last axis of p
+
+    Works for one spectrum (p of shape (3*npeaks,), x (npoints,)) as well as
+    for a stack (p (nspectra, 3*npeaks), x (nspectra, npoints)).
+    """
+    y = 0.
+    for j in range(0, p.shape[-1], 3):
+        height, mu, sigma = p[..., j, None], p[..., j + 1, None], p[..., j + 2, None]
+        y = y + height * np.exp(-((x - mu) / sigma) ** 2 / 2)
+    return y
+
+
+def Jacobian(p, x):
+    """Derivatives of Model() by the parameters, which go on the last axis"""
+    columns = []
+    for j in range(0, p.shape[-1], 3):
+        height, mu, sigma = p[..., j, None], p[..., j + 1, None], p[..., j + 2, None]
+        u = (x - mu) / sigma
+        e = np.exp(-u ** 2 / 2)
+        columns += [e, height * e * u / sigma, height * e * u ** 2 / sigma]
+    return np.stack(columns, axis=-1)
+
+
+def Window(x, p0, nsigma=5.):
+    """Slice of x within nsigma widths around the start values of all peaks
+
+    Falls back to all of x when the window would have fewer points than
+    there are parameters, e.g. for a zero width estimate.
+    """
+    mus = np.asarray(p0[1::3], dtype=float)
+    sigmas = np.abs(np.asarray(p0[2::3], dtype=float))
+    low = np.min(mus - nsigma * sigmas)
+    high = np.max(mus + nsigma * sigmas)
+    idx = np.flatnonzero((x >= low) & (x <= high))
+    if len(idx) <= len(p0):
+        return slice(None)
+    return slice(idx[0], idx[-1] + 1)
+
+
+def _Residual(p, x, y):
+    return Model(p, x) - y
+
+
+def _ColumnJacobian(p, x, y):
+    return Jacobian(p, x).T
+
+
+def Fit(x, y, p0, window=5., maxfev=800, full_output=False):
+    """Fits one spectrum
+
+    Args:
+        x, y (array): Energy scale and spectrum
+        p0 (sequence): Start values, 3 per peak
+        window (float): Half width of the fitted part of the spectrum in
+                        start widths, None to fit all of it
+        maxfev (int): Maximum number of model evaluations
+        full_output (bool): Also return the number of model evaluations and
+                            whether leastsq converged
+
+    Returns:
+        np.ndarray: Fitted parameters, with full_output in a tuple
+                    (parameters, evaluations, converged)
+    """
+    p0 = np.asarray(p0, dtype=float)
+    x = np.asarray(x, dtype=float)
+    if window:
+        selection = Window(x, p0, window)
+        x, y = x[selection], y[selection]
+    p1, cov, info, message, ier = scipy.optimize.leastsq(
+        _Residual, p0, args=(x, y), Dfun=_ColumnJacobian, col_deriv=1,
+        maxfev=maxfev, full_output=True)
+    if full_output:
+        return p1, info['nfev'], ier in (1, 2, 3, 4)
+    return p1
+
+
+def FitBatch(x, spectra, p0s, window=5., maxiter=50, tolerance=1e-8):
+    """Fits a stack of spectra, all with the same number of peaks
+
+    The fit windows of all spectra are cut out into one array as long as the
+    longest of them; points past the end of a shorter window get no weight.
+
+    Args:
+        x (array): Energy scale, common to all spectra
+        spectra (array): Spectra, one per row
+        p0s (array): Start values, one row per spectrum
+        window (float): As for Fit()
+        maxiter (int): Maximum number of iterations
+        tolerance (float): Relative decrease of the squared residuals below
+                           which a fit counts as converged
+
+    Returns:
+        tuple: (fitted parameters, one row per spectrum; boolean array, True
+               for the converged fits)
+    """
+    x = np.asarray(x, dtype=float)
+    spectra = np.atleast_2d(spectra)
+    p = np.array(p0s, dtype=float)
+    nspectra, nparams = p.shape
+    starts = np.zeros(nspectra, dtype=int)
+    stops = np.ones(nspectra, dtype=int) * len(x)
+    if window:
+        for i in range(nspectra):
+            starts[i], stops[i], step = Window(x, p[i], window).indices(len(x))
+    idx = starts[:, None] + np.arange(np.max(stops - starts))[None, :]
+    weight = (idx < stops[:, None]).astype(float)
+    idx = np.minimum(idx, len(x) - 1)
+    xs = x[idx]
+    ys = spectra[np.arange(nspectra)[:, None], idx]
+
+    diagonal = np.arange(nparams)
+    residual = (Model(p, xs) - ys) * weight
+    cost = np.sum(residual ** 2, axis=1)
+    damping = np.ones(nspectra) * 1e-3
+    active = np.ones(nspectra, dtype=bool)
+    converged = np.zeros(nspectra, dtype=bool)
+    for iteration in range(maxiter):
+        jacobian = Jacobian(p, xs) * weight[..., None]
+        normal = np.einsum('nmk,nml->nkl', jacobian, jacobian)
+        gradient = np.einsum('nmk,nm->nk', jacobian, residual)
+        scale = np.maximum(normal[:, diagonal, diagonal], 1e-12)
+        normal[:, diagonal, diagonal] += damping[:, None] * scale
+        step = np.linalg.solve(normal, -gradient[..., None])[..., 0]
+        step[~active] = 0
+        trial = p + step
+        trialresidual = (Model(trial, xs) - ys) * weight
+        trialcost = np.sum(trialresidual ** 2, axis=1)
+        better = active & (trialcost < cost)
+        converged |= better & (cost - trialcost <= tolerance * cost)
+        p[better] = trial[better]
+        residual[better] = trialresidual[better]
+        cost[better] = trialcost[better]
+        damping = np.where(better, damping * 0.3, damping * 10)
+        active &= ~converged & (damping < 1e10)
+        if not np.any(active):
+            break
+    return p, converged
@@ -0,0 +1,125 @@
+"""Difference of the float32 from the float64 UXS analysis
+
+Runs UXSDataPreProcessing.StandardAnalysis with dtype float64 and float32 on
+the same frames and reports how far the projections and the fitted peaks
+of the float32 analysis are off, and how long both take:
+    python UXSPrecisionCheck.py -n 500 --exprun exp=amolr2516:run=203
+    python UXSPrecisionCheck.py -n 500 --source replay=frames/
+
+Without --exprun the frames come from SyntheticSource, with --source as its
+options (e.g. frames recorded with SyntheticSource.Record to replay).
+
+The projection differences are relative to the maximum of the float64
+projection of the frame, the peak differences are in units of the energy
+scale. The script exits with 1 if a projection is off by more than
+--tolerance, or if the two analyses do not find the same peaks.
+"""
+import sys
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+import SyntheticSource
+
+# Outputs of StandardAnalysis, by their names in the exported files
+projections = [('UXSwf', 1), ('UXSwf_BGsub', 2)]
+peaks = ['pos1', 'sigma1', 'int1', 'pos2', 'sigma2', 'int2']
+
+
+def RunNumber(exprun):
+    for part in exprun.split(':'):
+        if part.startswith('run='):
+            return int(part[4:])
+
+
+def Compare(reference, result):
+    """Differences of one frame's StandardAnalysis results
+
+    Returns:
+        dict: Relative difference per projection, absolute difference per
+              peak parameter (NaN unless both found the peak), and whether
+              the same peaks were found
+    """
+    differences = {}
+    for name, i in projections:
+        scale = max(np.max(np.abs(reference[i])), 1e-12)
+        differences[name] = np.max(np.abs(result[i] - reference[i])) / scale
+    fit64, fit32 = np.asarray(reference[0]), np.asarray(result[0])
+    for name, value64, value32 in zip(peaks, fit64, fit32):
+        differences[name] = np.abs(value32 - value64)
+    differences['samepeaks'] = np.array_equal(np.isnan(fit64), np.isnan(fit32))
+    return differences
+
+
+def Report(differences, timings):
+    """Table of the differences over all frames, and the timings"""
+    lines = ['{0:<14}{1:>12}{2:>12}{3:>12}'.format('', 'mean', 'p99', 'max')]
+    for name in [name for name, i in projections] + peaks:
+        values = np.array([d[name] for d in differences])
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            lines.append('{0:<14}{1:>12}'.format(name, 'no peaks'))
+            continue
+        lines.append('{0:<14}{1:>12.3g}{2:>12.3g}{3:>12.3g}'.format(
+            name, np.mean(values), np.percentile(values, 99), np.max(values)))
+    lines.append('{0} of {1} frames with different peaks found'.format(
+        sum(not d['samepeaks'] for d in differences), len(differences)))
+    for dtype in ('float64', 'float32'):
+        lines.append('{0}: {1:.2f} ms per frame'.format(
+            dtype, 1e3 * np.mean(timings[dtype])))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the float32 with the float64 UXS analysis')
+    parser.add_argument('-n', '--events', help='Frames to compare',
+                        type=int, default=200)
+    parser.add_argument('--exprun', help='Read this run with the real psana '
+                                         'instead of synthetic events')
+    parser.add_argument('--source', default='',
+                        help='SyntheticSource options, e.g. replay=frames/')
+    parser.add_argument('--rows', help='Signal rows of the analysis',
+                        nargs=2, type=int, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--tolerance', help='Allowed relative difference of '
+                                            'the projections',
+                        type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if args.exprun is None:
+        SyntheticSource.Install(args.source)
+        args.exprun = 'exp=amolr2516:run=0:events={0}'.format(args.events)
+
+    import psana
+    import UXSDataPreProcessing
+    ds = psana.DataSource(args.exprun)
+    det = psana.Detector('OPAL1')
+    analyses = dict(
+        (dtype, UXSDataPreProcessing.UXSDataPreProcessing(
+            run=RunNumber(args.exprun), signalrows=args.rows, dtype=dtype))
+        for dtype in ('float64', 'float32'))
+
+    differences = []
+    timings = {'float64': [], 'float32': []}
+    frames = (det.raw(evt) for evt in ds.events())
+    for frame in itertools.islice(
+            (frame for frame in frames if frame is not None), args.events):
+        results = {}
+        for dtype, analysis in analyses.items():
+            start = time.time()
+            results[dtype] = analysis.StandardAnalysis(frame)
+            timings[dtype].append(time.time() - start)
+        differences.append(Compare(results['float64'], results['float32']))
+    if not differences:
+        sys.exit('No UXS frames in ' + args.exprun)
+    print Report(differences, timings)
+
+    worst = max(max(d[name] for name, i in projections) for d in differences)
+    if worst > args.tolerance:
+        print 'FAILED: projections off by up to {0:.3g}'.format(worst)
+    if not all(d['samepeaks'] for d in differences):
+        print 'FAILED: different peaks found'
+    if worst > args.tolerance or not all(d['samepeaks'] for d in differences):
+        sys.exit(1)
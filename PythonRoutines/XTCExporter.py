@@ -1,14 +1,24 @@
+import os
+# Off-site runs on generated events, see SyntheticSource.py
+if os.environ.get('AMOLR2516_SOURCE'):
+    import SyntheticSource
+    SyntheticSource.Install(os.environ['AMOLR2516_SOURCE'])
 from psana import *
 import numpy as np
-import scipy.io
 from xtcav.ShotToShotCharacterization import *
-import os
 from mpi4py import MPI
 import argparse
 
+import EventScheduler
+import ExportBuffers
+import ExportManifest
+from ExportBuffers import validbits
+import ExportWriters
+import RunIndex
 import ITOFDataPreProcessing
 import UXSDataPreProcessing
 import SHESPreProcessing
+import StageTimer
 import XTCAV_Processing
 
 # Parallel processing
@@ -22,6 +32,18 @@ size = comm.Get_size()
 
 
 class XTCExporter(object):
+    # Per-shot staging arrays, swapped as one set when writing in the background
+    buffernames = ('shProjArr', 'uxsPCArr', 'uxsProjArr', 'uxsProjArr2',
+                   'itofArr', 'itofYield', 'gmdArr', 'envArr', 'ebeamArr',
+                   'sPressArr', 'xtcavPCArr', 'TimeSt', 'validArr')
+
+    # Detectors of which at least one has to deliver for a shot to be kept
+    usefulmask = (validbits['EBeam'] | validbits['SHES'] | validbits['UXS'] |
+                  validbits['ITOF'] | validbits['GMD'])
+
+    # Samples per ITOF waveform
+    itoflength = 40000
+
     def __init__(self, args):
         self.args = args
 
@@ -29,37 +51,171 @@ class XTCExporter(object):
 
     def run(self):
 
-        self.filenum = 0
+        self.timer = StageTimer.StageTimer(memory=self.args.profilememory)
+        # Event numbers advance by size per rank with static scheduling
+        self.stride = 1 if self.args.schedule == 'dynamic' else size
+        self.ResumeInit()
+        if self.args.schedule == 'dynamic':
+            if size < 2:
+                raise ValueError('dynamic scheduling needs at least 2 MPI ranks')
+            if rank == 0:
+                self.Serve()
+                self.Finalize()
+                return
+
         self.DetInit()
+        self.ITOFAxisInit()
+        self.WriterInit()
         self.endrun = False
         self.loop_idx = 0
-        self.ArrInit(1024)
-        for nevent, evt in enumerate(self.ds.events()):
-            if nevent == self.args.noe:
-                break
-            if nevent % (size) != rank:
-                continue  # different ranks look at different events
+        self.nrejected = 0
+        self.BufferInit(1024)
+        t = self.timer.Tic()
+        for nevent, evt in self.Events():
+            self.timer.Toc('next_event', t)
             self.loop_idx += 1
 
             self.getevtdata(evt)
+            self.Consumed(nevent)
 
             # print self.nsave
-            if hasattr(self, 'nsave') and self.nsave == self.args.nsave:
+            if hasattr(self, 'nsave') and self.nsave == self.nbuffer:
                 self.save()
+            t = self.timer.Tic()
 
         self.save()
-
+        if self.args.save is True:
+            t = self.timer.Tic()
+            self.writer.close()
+            self.timer.Toc('save', t)
+            if self.args.nbuffers > 1:
+                print 'Rank {0} writer: {1}'.format(rank, self.writer.Stats())
+
+        if self.args.prefilter:
+            print 'Rank {0} pre-filter rejected {1} of {2} events'.format(
+                rank, self.nrejected, self.loop_idx)
+        print 'Rank {0} UXS fits: {1}'.format(rank, self.UXS_Pre.FitStatistics())
+        self.Finalize()
         print 'Client', rank, 'done'
 
+    def Finalize(self):
+        """End of run on all ranks: timing report and, once every rank has
+        closed its files, the run-level index"""
+        self.ReportTiming()
+        comm.Barrier()
+        if rank == 0 and self.args.save is True:
+            indexfile = RunIndex.Build(int(self.args.exprun[18:]),
+                                       self.args.format)
+            print 'Run index written to', indexfile
+
+    def ReportTiming(self):
+        """Sums the stage timers of all ranks, prints the table on rank 0 and
+        writes it, with a JSON profile, next to the output files"""
+        total = self.timer.Reduce(comm)
+        if rank != 0:
+            return
+        print total.Summary()
+        if self.args.save is True:
+            runnumber = int(self.args.exprun[18:])
+            kind = ExportWriters.formats[self.args.format][0]
+            total.Save(ExportWriters.RunDirectory(kind, runnumber) +
+                       'amolr2516_r' + str(runnumber).zfill(4) + '_profile')
+
 ###############################################################################
 
-    def DetInit(self):
+    def ResumeInit(self):
+        """Reads (with --resume) or clears the export manifests of the run
+
+        Sets self.entries, the completed files of all ranks, and self.done,
+        a boolean array over event numbers that is True for the events that
+        are already in completed files. Files of the run that a killed job
+        left incomplete are deleted. Without --resume all export files of
+        the run are deleted, so that RunIndex does not pick up files of an
+        earlier export with more files or ranks.
+        """
+        entries = []
+        if self.args.save is True and rank == 0:
+            runnumber = int(self.args.exprun[18:])
+            kind, ext = ExportWriters.formats[self.args.format]
+            directory = ExportWriters.RunDirectory(kind, runnumber)
+            if self.args.resume:
+                entries = ExportManifest.LoadAll(directory, runnumber)
+                filenames = RunIndex.RunFiles(directory, runnumber, ext)
+                ExportManifest.RemoveIncomplete(filenames, entries)
+                print 'Resuming run {0}: {1} files already complete'.format(
+                    runnumber, len(entries))
+            else:
+                ExportManifest.RemoveAll(directory, runnumber)
+                ExportManifest.RemoveIncomplete(
+                    RunIndex.RunFiles(directory, runnumber, ext), [])
+        self.entries = comm.bcast(entries, root=0)
+        self.done = ExportManifest.DoneEvents(self.entries)
+
+    def Consumed(self, nevent):
+        """Adds nevent to the event ranges of the chunk being staged"""
+        if (self.eventranges and
+                nevent == self.eventranges[-1][1] + self.stride):
+            self.eventranges[-1][1] = nevent
+        else:
+            self.eventranges.append([nevent, nevent])
+
+###############################################################################
+
+    def Serve(self):
+        """Rank 0 in dynamic mode: hands out event batches to the workers"""
+        times = self.IndexedRun().times()
+        nevents = len(times)
+        if self.args.noe >= 0:
+            nevents = min(nevents, self.args.noe)
+        done = np.zeros((nevents,), dtype=bool)
+        ndone = min(nevents, len(self.done))
+        done[:ndone] = self.done[:ndone]
+        events = np.flatnonzero(~done)
+        nbatches = EventScheduler.Serve(comm, events, self.args.batch)
+        print 'Master handed out {0} events, batches per rank: {1}'.format(
+            len(events), nbatches)
+
+    def IndexedRun(self):
         self.ds = DataSource(self.args.exprun +
-                             ':smd:dir=/reg/d/psdm/amo/amolr2516/xtc:live')
+                             ':idx:dir=/reg/d/psdm/amo/amolr2516/xtc')
+        return self.ds.runs().next()
+
+    def Events(self):
+        """Yields (nevent, evt) for the events this rank has to process
+
+        Static scheduling walks the small data and keeps every size-th event,
+        dynamic scheduling asks rank 0 for batches of event indices and reads
+        those events from the indexed run.
+        """
+        if self.args.schedule == 'dynamic':
+            times = self.psrun.times()
+            for batch in EventScheduler.Batches(comm):
+                for nevent in batch:
+                    yield nevent, self.psrun.event(times[nevent])
+            return
+        for nevent, evt in enumerate(self.ds.events()):
+            if nevent == self.args.noe:
+                break
+            if nevent % (size) != rank:
+                continue  # different ranks look at different events
+            if nevent < len(self.done) and self.done[nevent]:
+                continue  # already exported before a restart
+            yield nevent, evt
+
+###############################################################################
+
+    def DetInit(self):
+        if self.args.schedule == 'dynamic':
+            self.psrun = self.IndexedRun()
+        else:
+            self.ds = DataSource(self.args.exprun +
+                                 ':smd:dir=/reg/d/psdm/amo/amolr2516/xtc:live')
 
         self.SHES = SHESPreProcessing.SHESPreProcessor()
         self.UXS = Detector(self.args.UXS)
-        self.UXS_Pre = UXSDataPreProcessing.UXSDataPreProcessing()
+        self.UXS_Pre = UXSDataPreProcessing.UXSDataPreProcessing(
+            run=int(self.args.exprun[18:]), signalrows=self.args.uxsrows,
+            dtype=self.args.uxsdtype, warmstart=self.args.uxswarmstart)
         self.ITOF = Detector(self.args.ITOF)
         self.XTCAV = XTCAV_Processing.XTCavProcessor()
         self.XTCAV.set_data_source(self.ds)
@@ -69,6 +225,93 @@ class XTCExporter(object):
         self.PRESS = Detector('AMO:LMP:VG:21:PRESS')
         self.CHIC = Detector('SIOC:SYS0:ML01:AO901')
 
+    def ITOFAxisInit(self):
+        """Sample window and binning of the stored ITOF traces
+
+        The traces are cropped to args.crop ([start, stop] in samples, stop 0
+        for the end of the trace) and, unless args.rebin is 'none', combined
+        into args.bins bins. The window has to be a multiple of args.bins
+        samples long then. The ion yield is always computed from the full
+        trace.
+
+        Sets self.itofsamples, the centre of every stored bin in samples of
+        the raw trace, which is exported as ITOFSamples.
+        """
+        start, stop = self.args.crop
+        stop = stop or self.itoflength
+        if not 0 <= start < stop <= self.itoflength:
+            raise ValueError('ITOF crop window {0} outside of the {1} '
+                             'samples'.format(self.args.crop, self.itoflength))
+        if self.args.rebin == 'none':
+            binsize = 1
+            nbins = stop - start
+        else:
+            if (not 0 < self.args.bins <= stop - start or
+                    (stop - start) % self.args.bins != 0):
+                raise ValueError('cannot rebin {0} ITOF samples into {1} '
+                                 'bins, the crop window has to be a multiple '
+                                 'of the bins long'.format(stop - start,
+                                                           self.args.bins))
+            binsize = (stop - start) // self.args.bins
+            nbins = self.args.bins
+        self.itofwindow = (start, start + nbins * binsize)
+        self.itofbinsize = binsize
+        self.itofsamples = start + binsize * np.arange(nbins) + (binsize - 1) / 2.
+
+###############################################################################
+
+    def WriterInit(self):
+        """Sets up the output backend and the size of the staging arrays
+
+        With the HDF5 backend the arrays only hold args.chunk shots, which are
+        appended to the current file whenever they fill up. The .npz backend
+        needs the whole file in memory, i.e. args.nsave shots.
+
+        With args.nbuffers > 1 the writer runs in a background thread and the
+        event loop carries on in a spare set of staging arrays while the
+        filled set is written.
+        """
+        if self.args.format == 'hdf5':
+            self.nbuffer = self.args.chunk
+        else:
+            self.nbuffer = self.args.nsave
+        if self.args.save is not True:
+            return
+        runnumber = int(self.args.exprun[18:])
+        kind = ExportWriters.formats[self.args.format][0]
+        manifest = ExportManifest.Manifest(
+            ExportWriters.RunDirectory(kind, runnumber), runnumber, rank,
+            self.stride, self.entries)
+        filenum = ExportManifest.NextFileNum(self.entries, rank)
+        if self.args.format == 'hdf5':
+            self.writer = ExportWriters.HDF5Writer(
+                runnumber, rank, self.args.nsave, self.args.chunk, filenum,
+                manifest, self.args.datasetcodecs)
+        else:
+            self.writer = ExportWriters.NpzWriter(
+                runnumber, rank, filenum, manifest, self.args.datasetcodecs)
+        if self.args.nbuffers > 1:
+            self.writer = ExportWriters.BackgroundWriter(
+                self.writer, self.args.nbuffers - 1)
+
+###############################################################################
+
+    def BufferInit(self, uxslength):
+        """Allocates the staging arrays, plus the spare sets when writing
+        in the background"""
+        if self.args.save is True and self.args.nbuffers > 1:
+            for i in range(self.args.nbuffers - 1):
+                self.ArrInit(uxslength)
+                self.writer.free.put(self.GetBuffers())
+        self.ArrInit(uxslength)
+
+    def GetBuffers(self):
+        return dict((name, getattr(self, name)) for name in self.buffernames)
+
+    def SetBuffers(self, buffers):
+        for name, arr in buffers.items():
+            setattr(self, name, arr)
+
 ###############################################################################
 
     def ArrInit(self, uxslength):
@@ -76,26 +319,32 @@ class XTCExporter(object):
         # Scienta Hemispherical array 2D: Energy projection; index of event
         shlength = len(self.SHES.calib_array)
         self.shEnergy = np.zeros(shlength)
-        self.shProjArr = np.zeros((self.args.nsave, shlength))
-        self.ehitsX = []
-        self.ehitsY = []
-        self.ehitsTS = []
+        self.shProjArr = np.zeros((self.nbuffer, shlength))
+        # electron hits
+        self.ehits = ExportBuffers.HitBuffer()
 
         # UXS
         # XRay spectro array 2D principal components:
         # Ampl1,pos1,FWHM1,Ampl2,pos2,FWHM2
-        self.uxsPCArr = np.zeros((self.args.nsave, 6))
+        self.uxsPCArr = np.zeros((self.nbuffer, 6))
         # Xray spectro array 2D: Energy projection
-        self.uxsProjArr = np.zeros((self.args.nsave, uxslength))
-        self.uxsProjArr2 = np.zeros((self.args.nsave, uxslength))
+        self.uxsProjArr = np.zeros((self.nbuffer, uxslength))
+        self.uxsProjArr2 = np.zeros((self.nbuffer, uxslength))
 
         # ITOF
+        # micro tof: thresholded waveform, kept dense only in 'dense' mode.
+        # In 'sparse' mode only the above-threshold samples are kept, see
+        # ITOFSparseData()
+        if self.args.itofmode == 'sparse':
+            self.itofArr = None
+        else:
+            self.itofArr = np.zeros((self.nbuffer, len(self.itofsamples)))
         # micro tof: ion yield
-        self.itofArr = np.zeros((self.args.nsave, 40000))
+        self.itofYield = np.zeros((self.nbuffer,))
 
         # GMD
         # Gas detector array (6 ebeam EL3 values)
-        self.gmdArr = np.zeros((self.args.nsave, 6))
+        self.gmdArr = np.zeros((self.nbuffer, 6))
 
         # ENV
         # Acq parameters:
@@ -103,18 +352,36 @@ class XTCExporter(object):
         self.envArr = np.zeros((1, 5))
 
         # EBeam
-        self.ebeamArr = np.zeros((self.args.nsave, 21))
+        self.ebeamArr = np.zeros((self.nbuffer, 21))
 
         # EPICS
         # Sample pressure array
-        self.sPressArr = np.zeros((self.args.nsave))
+        self.sPressArr = np.zeros((self.nbuffer))
 
         # XTCAV
         # "principal components" - centre, width and sum of pulses
-        self.xtcavPCArr = np.zeros((self.args.nsave, 5))
+        self.xtcavPCArr = np.zeros((self.nbuffer, 5))
 
         # Time stamp array
-        self.TimeSt = np.zeros((self.args.nsave,))
+        self.TimeSt = np.zeros((self.nbuffer,))
+
+        # Which detectors delivered data, bits as in ExportBuffers.validbits
+        self.validArr = np.zeros((self.nbuffer,), dtype=np.uint8)
+
+        self.ArrReset()
+
+###############################################################################
+
+    def ArrReset(self):
+        """Empties the staging arrays without re-allocating them"""
+        # SHES electron hits
+        self.ehits.Clear()
+
+        # Events read for this chunk, see Consumed()
+        self.eventranges = []
+
+        # Sparse ITOF (indices, values) per staged shot
+        self.itofSparse = [None] * self.nbuffer
 
         # Chicane delay
         self.chicane_fs = np.nan
@@ -124,7 +391,9 @@ class XTCExporter(object):
         self.uxsProjArr[:, :] = np.nan
         self.uxsProjArr2[:, :] = np.nan
         self.uxsPCArr[:, :] = np.nan
-        self.itofArr[:, :] = np.nan
+        if self.itofArr is not None:
+            self.itofArr[:, :] = np.nan
+        self.itofYield[:] = np.nan
 
         self.gmdArr[:, :] = np.nan
         self.ebeamArr[:, :] = np.nan
@@ -132,12 +401,33 @@ class XTCExporter(object):
         self.TimeSt[:] = np.nan
         self.sPressArr[:] = np.nan
         self.xtcavPCArr[:, :] = np.nan
+        self.validArr[:] = 0
         self.nsave = 0
 
+    def RowReset(self, n):
+        """Empties the staging row n of a dropped shot, so that the next
+        shot, which reuses it, does not export its values"""
+        self.itofSparse[n] = None
+        self.shProjArr[n, :] = np.nan
+        self.uxsProjArr[n, :] = np.nan
+        self.uxsProjArr2[n, :] = np.nan
+        self.uxsPCArr[n, :] = np.nan
+        if self.itofArr is not None:
+            self.itofArr[n, :] = np.nan
+        self.itofYield[n] = np.nan
+
+        self.gmdArr[n, :] = np.nan
+        self.ebeamArr[n, :] = np.nan
+        self.TimeSt[n] = np.nan
+        self.sPressArr[n] = np.nan
+        self.xtcavPCArr[n, :] = np.nan
+        self.validArr[n] = 0
+
 
 ###############################################################################
 
     def getevtdata(self, evt):
+        t = self.timer.Tic()
         # Initialize the arrays
         if not hasattr(self, 'shEnergy'):
             shEnergy = len(self.SHES.calib_array)
@@ -165,39 +455,104 @@ class XTCExporter(object):
         except Exception as e:
             print 'getting event time failed with exception {0}'.format(e)
             return
+        # the slot may hold the flags of a shot that was dropped
+        self.validArr[self.nsave] = 0
+
+        # Cheap scalars first, so that the pre-filter can reject the shot
+        # before any of the big detectors are read
+        gmddata = self.GMD.get(evt)
+        samplepressuredata = self.PRESS(evt)
+
+        # Get the Ebeam data
+        EBeamdata = self.EBeam.get(evt)
+        if EBeamdata is not None:
+            # record ebeam parameters
+            ebeamlistpar = ['damageMask', 'ebeamCharge', 'ebeamDumpCharge', 'ebeamEnergyBC1',
+                            'ebeamEnergyBC2', 'ebeamL3Energy', 'ebeamLTU250', 'ebeamLTU450',
+                            'ebeamLTUAngX', 'ebeamLTUAngY', 'ebeamLTUPosX', 'ebeamLTUPosY',
+                            'ebeamPhotonEnergy', 'ebeamPkCurrBC1', 'ebeamPkCurrBC2', 'ebeamUndAngX',
+                            'ebeamUndAngY', 'ebeamUndPosX', 'ebeamUndPosY', 'ebeamXTCAVAmpl', 'ebeamXTCAVPhase']
+
+            for i, par in enumerate(ebeamlistpar):
+                self.ebeamArr[self.nsave, i] = getattr(EBeamdata, par)()
+            self.validArr[self.nsave] |= validbits['EBeam']
+        else:
+            print 'No EBeam data ({0} events saved)'.format(self.nsave)
+
+        if gmddata is not None:
+            # upstream
+            self.gmdArr[self.nsave, 0] = gmddata.f_11_ENRC()
+            self.gmdArr[self.nsave, 1] = gmddata.f_12_ENRC()
+            # downstream
+            self.gmdArr[self.nsave, 2] = gmddata.f_21_ENRC()
+            self.gmdArr[self.nsave, 3] = gmddata.f_22_ENRC()
+            # set values
+            self.gmdArr[self.nsave, 4] = gmddata.f_63_ENRC()
+            self.gmdArr[self.nsave, 5] = gmddata.f_64_ENRC()
+
+            self.validArr[self.nsave] |= validbits['GMD']
+        else:
+            print 'No Gas Detector data ({0} events saved)'.format(self.nsave)
+
+        if samplepressuredata is not None:
+            self.sPressArr[self.nsave] = samplepressuredata
+            self.validArr[self.nsave] |= validbits['Pressure']
+        else:
+            print 'No pressure data ({0} events saved)'.format(self.nsave)
+
+        if not self.PreFilter(evt, EBeamdata, gmddata, samplepressuredata):
+            self.nrejected += 1
+            self.RowReset(self.nsave)
+            self.timer.Toc('scalars', t)
+            return
+        t = self.timer.Toc('scalars', t)
 
         # Get the hemisperical analyser signal data
         lx, ly, proj, proj_raw = self.SHES.PreProcess(evt)
-        self.ehitsX += lx  # Xpos
-        self.ehitsY += ly  # Ypos
-        # electron hits timestamps
-        self.ehitsTS += list(np.ones((len(lx))) * evttime.time())
+        nhits = len(self.ehits)
+        self.ehits.Append(lx, ly, evttime.time(), self.nsave)
         self.shProjArr[self.nsave, :] = proj
+        # PreProcess returns [nan] placeholders when there is no image
+        if not np.isnan(proj[0]):
+            self.validArr[self.nsave] |= validbits['SHES']
         if any((any(np.isnan(lx)),
                 any(np.isnan(ly)),
                 any(np.isnan(proj)),
                 any(np.isnan(proj_raw)))):
             print 'Pre-processing of SHES data failed'
+        t = self.timer.Toc('shes', t)
 
         # Get the Xray spectrometer analyser data
         XrayImg = self.UXS.raw(evt)
+        t = self.timer.Toc('uxs_read', t)
         if XrayImg is not None:
             PCs, proj, proj2 = self.UXS_Pre.StandardAnalysis(XrayImg)
             self.uxsPCArr[self.nsave, :] = PCs
             self.uxsProjArr[self.nsave, :] = proj
             self.uxsProjArr2[self.nsave, :] = proj2
+            self.validArr[self.nsave] |= validbits['UXS']
         else:
             print 'No UXS data ({0} events saved)'.format(self.nsave)
+        t = self.timer.Toc('uxs', t)
 
         # Get the ITOF data
         waveforms = self.ITOF.waveform(evt)
+        t = self.timer.Toc('itof_read', t)
         if waveforms is not None:
             waveform = waveforms[1]
             tmp = ITOFDataPreProcessing.ITOFDataPreProcessing(waveform)
-            tmp.StandardAnalysis()
-            self.itofArr[self.nsave, :] = tmp.wf
+            self.itofYield[self.nsave] = tmp.StandardAnalysis()
+            if self.itofbinsize > 1 or self.itofwindow != (0, self.itoflength):
+                tmp.CropRebin(self.itofwindow, self.itofbinsize,
+                              self.args.rebin)
+            if self.args.itofmode == 'sparse':
+                self.itofSparse[self.nsave] = tmp.SparseWaveform()
+            else:
+                self.itofArr[self.nsave, :] = tmp.wf
+            self.validArr[self.nsave] |= validbits['ITOF']
         else:
             print 'No ITOF data ({0} events saved)'.format(self.nsave)
+        t = self.timer.Toc('itof', t)
 
         # Get the XTCAV data
         # self.XTCAV.set_event(evt)
@@ -211,47 +566,14 @@ class XTCExporter(object):
                 self.XTCAV.results['moment_fwhms'][1],  # pump
                 self.XTCAV.results['pulse_sums'][1]  # probe
             ]
-
-        gmddata = self.GMD.get(evt)
-        samplepressuredata = self.PRESS(evt)
-
-        # Get the Ebeam data
-        EBeamdata = self.EBeam.get(evt)
-        if EBeamdata is not None:
-            # record ebeam parameters
-            ebeamlistpar = ['damageMask', 'ebeamCharge', 'ebeamDumpCharge', 'ebeamEnergyBC1',
-                            'ebeamEnergyBC2', 'ebeamL3Energy', 'ebeamLTU250', 'ebeamLTU450',
-                            'ebeamLTUAngX', 'ebeamLTUAngY', 'ebeamLTUPosX', 'ebeamLTUPosY',
-                            'ebeamPhotonEnergy', 'ebeamPkCurrBC1', 'ebeamPkCurrBC2', 'ebeamUndAngX',
-                            'ebeamUndAngY', 'ebeamUndPosX', 'ebeamUndPosY', 'ebeamXTCAVAmpl', 'ebeamXTCAVPhase']
-
-            for i, par in enumerate(ebeamlistpar):
-                self.ebeamArr[self.nsave, i] = getattr(EBeamdata, par)()
-        else:
-            print 'No EBeam data ({0} events saved)'.format(self.nsave)
-
-        if gmddata is not None:
-            # upstream
-            self.gmdArr[self.nsave, 0] = gmddata.f_11_ENRC()
-            self.gmdArr[self.nsave, 1] = gmddata.f_12_ENRC()
-            # downstream
-            self.gmdArr[self.nsave, 2] = gmddata.f_21_ENRC()
-            self.gmdArr[self.nsave, 3] = gmddata.f_22_ENRC()
-            # set values
-            self.gmdArr[self.nsave, 4] = gmddata.f_63_ENRC()
-            self.gmdArr[self.nsave, 5] = gmddata.f_64_ENRC()
-
-            gmd = self.gmdArr[self.nsave, self.args.prefgmd]
-        else:
-            print 'No Gas Detector data ({0} events saved)'.format(self.nsave)
-
-        if samplepressuredata is not None:
-            self.sPressArr[self.nsave] = samplepressuredata
-        else:
-            print 'No pressure data ({0} events saved)'.format(self.nsave)
+            self.validArr[self.nsave] |= validbits['XTCAV']
+        self.timer.Toc('xtcav', t)
 
         if self.no_useful_data(self.nsave):
             print 'No errors but no useful data at shot ', self.loop_idx
+            # the slot is reused by the next shot, so are its hits
+            self.ehits.Truncate(nhits)
+            self.RowReset(self.nsave)
         else:
             self.nsave += 1
         if self.nsave % 100 == 0:
@@ -259,11 +581,38 @@ class XTCExporter(object):
                 self.loop_idx, rank, self.nsave)
 ###############################################################################
 
+    def PreFilter(self, evt, EBeamdata, gmddata, samplepressuredata):
+        """Checks the cheap scalars of a shot against args.prefilter
+
+        args.prefilter maps 'gmd' (gas detector args.prefgmd), 'l3' (e-beam
+        L3 energy), 'chicane' and 'pressure' to a (low, high) window.
+
+        Returns:
+            Bool: True if the shot is inside every configured window. A shot
+                  without the value of a configured window is rejected.
+        """
+        for name, (low, high) in self.args.prefilter.items():
+            value = None
+            if name == 'gmd' and gmddata is not None:
+                value = self.gmdArr[self.nsave, self.args.prefgmd]
+            elif name == 'l3' and EBeamdata is not None:
+                value = EBeamdata.ebeamL3Energy()
+            elif name == 'chicane':
+                value = self.CHIC(evt)
+            elif name == 'pressure':
+                value = samplepressuredata
+            if value is None or not low <= value <= high:
+                return False
+        return True
+
     def no_useful_data(self, nsave, verbose=False):
         """Checks whether for the shot saved at nsave, there is any data at all
         Does not check the timestamp since that's never NaN
         Does not check the pressure since it is not important
 
+        Uses the detector flags in validArr rather than scanning the arrays
+        for NaNs.
+
         Args:
             nsave (int): Index into the saved data array
 
@@ -271,105 +620,95 @@ class XTCExporter(object):
             Bool: True if there is no useful data at all, False if there is
                   some useful data in the shot
         """
-        if not np.isnan(self.ebeamArr[nsave, :]).all():
-            if verbose:
-                print 'Found Ebeam data'
-            return False
-        if not np.isnan(self.shProjArr[nsave, :]).all():
-            if verbose:
-                print 'Found SHES proj data'
-            return False
-        if not np.isnan(self.uxsPCArr[nsave, :]).all():
-            if verbose:
-                print 'Found UXS PCs data'
-            return False
-        if not np.isnan(self.uxsProjArr[nsave, :]).all():
-            if verbose:
-                print 'Found UXS proj'
-            return False
-        if not np.isnan(self.uxsProjArr2[nsave, :]).all():
-            if verbose:
-                print 'Found UXS proj2'
-            return False
-        if not np.isnan(self.itofArr[nsave, :]).all():
-            if verbose:
-                print 'Found ITOF data'
-            return False
-        if not np.isnan(self.gmdArr[nsave, :]).all():
-            if verbose:
-                print 'Found gas detector data'
-            return False
-        return True
+        valid = self.validArr[nsave]
+        if verbose:
+            for name, bit in sorted(validbits.items(), key=lambda x: x[1]):
+                if valid & bit:
+                    print 'Found {0} data'.format(name)
+        return not (valid & self.usefulmask)
 
 ###############################################################################
 
-    def save(self):
-        if self.args.save is True:
-            runnumber = int(self.args.exprun[18:])
-            filename = 'amolr2516_r' + str(runnumber).zfill(4) + '_' + \
-                str(rank).zfill(3) + '_' + str(self.filenum).zfill(3)
-
-            directory_n = ('/reg/d/psdm/AMO/amolr2516/results/npzfiles/'
-                           + 'run'
-                           + str(runnumber).zfill(4)
-                           + '/')
-            directory_m = ('/reg/d/psdm/AMO/amolr2516/results/matfiles/'
-                           + 'run'
-                           + str(runnumber).zfill(4)
-                           + '/')
-            if not os.path.exists(directory_n):
-                os.makedirs(directory_n)
-            if not os.path.exists(directory_m):
-                os.makedirs(directory_m)
-            directory_n = ('/reg/d/psdm/AMO/amolr2516/results/npzfiles/'
-                           + 'run'
-                           + str(runnumber).zfill(4)
-                           + '/')
-            directory_m = ('/reg/d/psdm/AMO/amolr2516/results/matfiles/'
-                           + 'run'
-                           + str(runnumber).zfill(4)
-                           + '/')
-            if not os.path.exists(directory_n):
-                os.makedirs(directory_n)
-            if not os.path.exists(directory_m):
-                os.makedirs(directory_m)
-
-            if rank == 1:
-                print 'rank 1 writing file...'
-
-        # Save electrons hits in one array:
-        SHESHits = np.zeros((len(self.ehitsX), 3))
-        SHESHits[:, 0] = self.ehitsX
-        SHESHits[:, 1] = self.ehitsY
-        SHESHits[:, 2] = self.ehitsTS
+    def ChunkData(self):
+        """Collects the shots staged so far into the dict handed to the writer
 
+        Returns:
+            dict: Dataset name -> array, first axis is the shot index except
+                  for the SHESHits* columns (one row per hit), the sparse ITOF
+                  samples and the per-file entries
+        """
+        hits = self.ehits.Columns()
         data = {'EBeamParameters': self.ebeamArr[0:self.nsave, :],
-                'SHESHits': SHESHits.astype(np.float64),
+                'SHESHitsX': hits['x'],
+                'SHESHitsY': hits['y'],
+                'SHESHitsTS': hits['ts'],
+                'SHESHitsShot': hits['shot'],
                 'SHESwf': self.shProjArr[0:self.nsave, :].astype(np.float32),
                 'UXSpc': self.uxsPCArr[0:self.nsave, :].astype(np.float32),
                 'UXSwf': self.uxsProjArr[0:self.nsave, :].astype(np.float32),
                 'UXSwf_BGsub': self.uxsProjArr2[0:self.nsave, :].astype(np.float32),
-                'ITOF': self.itofArr[0:self.nsave, :].astype(np.float32),
+                'ITOFYield': self.itofYield[0:self.nsave],
+                'ITOFLength': len(self.itofsamples),
+                'ITOFSamples': self.itofsamples,
                 'XTCAV': self.xtcavPCArr[0:self.nsave, :],
                 'Pressure': self.sPressArr[0:self.nsave],
                 'GasDetector': self.gmdArr[0:self.nsave, :],
                 'EnvVar': self.envArr,
                 'chicane_fs': self.chicane_fs,
-                'TimeStamp': self.TimeSt[0:self.nsave]}
-        scipy.io.savemat(directory_m + filename + '.mat', data)
+                'TimeStamp': self.TimeSt[0:self.nsave],
+                'Valid': self.validArr[0:self.nsave],
+                ExportWriters.progresskey: self.eventranges}
+        if self.args.itofmode == 'sparse':
+            data.update(self.ITOFSparseData())
+        else:
+            data['ITOF'] = self.itofArr[0:self.nsave, :].astype(np.float32)
+        return data
+
+    def ITOFSparseData(self):
+        """Packs the staged ITOF samples CSR style
+
+        ITOFIndex and ITOFValue hold the above-threshold samples of all shots
+        one after the other, ITOFnnz how many of them belong to each shot.
+        ExportReaders.ITOFTraces() turns them back into dense traces.
+        """
+        shots = [s for s in self.itofSparse[0:self.nsave] if s is not None]
+        nnz = [0 if s is None else len(s[0])
+               for s in self.itofSparse[0:self.nsave]]
+        if shots:
+            index = np.concatenate([s[0] for s in shots])
+            value = np.concatenate([s[1] for s in shots])
+        else:
+            index = np.zeros((0,), dtype=np.int32)
+            value = np.zeros((0,), dtype=np.float32)
+        return {'ITOFIndex': index,
+                'ITOFValue': value,
+                'ITOFnnz': np.array(nnz, dtype=np.uint32)}
+
+###############################################################################
 
-        np.savez(directory_n + filename, **data)
-        if rank == 1:
-            print 'rank1 done with writing file.'
-        self.filenum += 1
-        self.ArrInit(1024)
+    def save(self):
+        t = self.timer.Tic()
+        if self.args.save is True:
+            if rank == 1:
+                print 'rank 1 writing file...'
+            if self.args.nbuffers > 1:
+                # Hand the filled arrays to the writer thread and continue in
+                # a set that has already been written
+                self.writer.write(self.ChunkData(), self.GetBuffers())
+                self.SetBuffers(self.writer.GetFree())
+            else:
+                self.writer.write(self.ChunkData())
+            if rank == 1:
+                print 'rank1 done with writing file.'
+        self.ArrReset()
+        self.timer.Toc('save', t)
 
 ###############################################################################
 
 
-# def runclient(args):
-#     client = XTCExporter(args)
-#     client.run()
+def runclient(args):
+    client = XTCExporter(args)
+    client.run()
 
 
 if __name__ == '__main__':
@@ -383,8 +722,130 @@ if __name__ == '__main__':
         help="number of events, all events=0",
         default=-1,
         type=int)
+    parser.add_argument(
+        "-f",
+        "--format",
+        help="output format, .npz files per chunk or HDF5 (MATLAB files are "
+             "made afterwards with MatConverter.py)",
+        choices=['npz', 'hdf5'],
+        default='hdf5')
+    parser.add_argument(
+        "-b",
+        "--nbuffers",
+        help="sets of staging arrays, more than 1 writes in the background. "
+             "Every set holds --chunk shots with hdf5, but a whole file "
+             "with npz (about 1.7 GB per rank for 5000 dense ITOF traces). "
+             "Default 2 with hdf5, 1 with npz",
+        type=int)
+    parser.add_argument(
+        "--itofmode",
+        help="store full ITOF traces, or only the above-threshold samples",
+        choices=['dense', 'sparse'],
+        default='dense')
+    parser.add_argument(
+        "-s",
+        "--schedule",
+        help="static: every rank takes every size-th event, dynamic: rank 0 "
+             "hands out batches of events to idle ranks",
+        choices=['static', 'dynamic'],
+        default='static')
+    parser.add_argument(
+        "--prefilter",
+        help="only process shots with LOW <= NAME <= HIGH, NAME one of "
+             "gmd, l3, chicane, pressure (can be repeated)",
+        nargs=3,
+        action='append',
+        default=[],
+        metavar=('NAME', 'LOW', 'HIGH'))
+    parser.add_argument(
+        "--profile-memory",
+        dest="profilememory",
+        help="also record peak memory growth per stage in the timing profile",
+        action='store_true')
+    parser.add_argument(
+        "--resume",
+        help="skip the events already in completed files of an earlier, "
+             "killed export of the same run",
+        action='store_true')
+    parser.add_argument(
+        "--batch",
+        help="events per batch with dynamic scheduling",
+        default=20,
+        type=int)
+    parser.add_argument(
+        "--crop",
+        help="ITOF samples to keep, STOP 0 for the end of the trace",
+        nargs=2,
+        type=int,
+        default=[0, 0],
+        metavar=('START', 'STOP'))
+    parser.add_argument(
+        "--rebin",
+        help="combine the cropped ITOF samples into --bins bins",
+        choices=['none', 'sum', 'mean'],
+        default='none')
+    parser.add_argument(
+        "--bins",
+        help="number of ITOF bins with --rebin, which has to divide the "
+             "--crop window",
+        default=2500,
+        type=int)
+    parser.add_argument(
+        "--uxs-rows",
+        dest="uxsrows",
+        help="only analyse these rows of the UXS camera (default all)",
+        nargs=2,
+        type=int,
+        metavar=('FIRST', 'LAST'))
+    parser.add_argument(
+        "--uxs-dtype",
+        dest="uxsdtype",
+        help="floating point type of the UXS analysis, see "
+             "UXSPrecisionCheck.py",
+        choices=['float64', 'float32'],
+        default='float64')
+    parser.add_argument(
+        "--uxs-warmstart",
+        dest="uxswarmstart",
+        help="start the UXS fits from a running average of the earlier "
+             "fits, with this weight of the newest one (e.g. 0.3)",
+        type=float)
+    parser.add_argument(
+        "--codec",
+        help="compression of all datasets (npz files: none or zlib only), "
+             "see CodecBenchmark.py",
+        choices=sorted(ExportWriters.codecs),
+        default='none')
+    parser.add_argument(
+        "--dataset-codec",
+        dest="datasetcodec",
+        help="compression of one dataset, e.g. ITOF shuffle-lzf "
+             "(can be repeated)",
+        nargs=2,
+        action='append',
+        default=[],
+        metavar=('DATASET', 'CODEC'))
 
     args = parser.parse_args()
+    datasetcodecs = {'default': args.codec}
+    for name, codec in args.datasetcodec:
+        datasetcodecs[name] = codec
+    for codec in datasetcodecs.values():
+        if codec not in ExportWriters.codecs:
+            parser.error('unknown codec {0}'.format(codec))
+        if args.format == 'npz' and codec not in ExportWriters.npzcodecs:
+            parser.error('codec {0} is not available for npz files'.format(
+                codec))
+    args.datasetcodecs = datasetcodecs
+    if args.nbuffers is None:
+        # A spare set of npz staging arrays costs a whole file of memory
+        args.nbuffers = 2 if args.format == 'hdf5' else 1
+    prefilter = {}
+    for name, low, high in args.prefilter:
+        if name not in ('gmd', 'l3', 'chicane', 'pressure'):
+            parser.error('unknown pre-filter {0}'.format(name))
+        prefilter[name] = (float(low), float(high))
+    args.prefilter = prefilter
     args.SHES = 'OPAL3'
     args.UXS = 'OPAL1'
     args.ITOF = 'ACQ1'  # 'Acq01'#'ACQ1'
@@ -403,8 +864,10 @@ if __name__ == '__main__':
 
     # Save files:
     args.save = True
-    # Number of shots saved per file
+    # Number of shots saved per file (a multiple of args.chunk with hdf5)
     args.nsave = 5000
+    # Number of shots staged in memory before appending them to the HDF5 file
+    args.chunk = 100
 
     exporter = XTCExporter(args)
     exporter.run()
@@ -41,8 +41,33 @@ args.prefgmd = 0
 
 # Save files:
 args.save = True
-# Number of shots saved per file
+# Number of shots saved per file (a multiple of args.chunk with hdf5)
 args.nsave  = 10000
+# Output format ('npz' or 'hdf5') and shots staged per HDF5 append.
+# MATLAB files are made afterwards with MatConverter.py:
+args.format = 'hdf5'
+args.chunk  = 100
+# Sets of staging arrays (more than 1 writes files in a background thread).
+# With npz every set holds a whole file (~3.3 GB for 10000 shots of dense
+# ITOF), so use 1 there:
+args.nbuffers = 2 if args.format == 'hdf5' else 1
+# ITOF traces stored 'dense' or as above-threshold samples ('sparse'):
+args.itofmode = 'dense'
+# Event distribution: 'static' (nevent%size) or 'dynamic' (rank 0 hands out
+# batches of args.batch events to idle ranks, needs at least 2 ranks):
+args.schedule = 'static'
+args.batch    = 20
+# Pre-filter on cheap scalars before reading the big detectors, e.g.
+# {'gmd': (0.1, np.inf), 'l3': (3300, 3400)}; keys gmd, l3, chicane, pressure:
+args.prefilter = {}
+# Attribute peak memory growth to the stages of the timing profile:
+args.profilememory = False
+# Continue an export that was killed, skipping events in completed files:
+args.resume = False
+# Compression per dataset, 'default' for all others (codecs are listed in
+# ExportWriters.codecs, npz files only support 'zlib'), e.g.
+# {'default': 'none', 'ITOF': 'shuffle-lzf', 'UXSwf': 'shuffle-lzf'}:
+args.datasetcodecs = {'default': 'none'}
 # number of shots transfered for online plots:
 #args.nonline = 120
 
@@ -52,10 +77,19 @@ args.nsave  = 10000
 #args.cfdFraction  = 0.5
 #args.cfdDeadtime  = 20
 
-# Rebinning of raw MBES traces to save to files:
-#args.rebin = False
-#args.bins  = 2500
-#args.crop =[0,0]
+# Cropping ([start, stop] samples, stop 0 for the end) and rebinning
+# ('none', 'sum' or 'mean' into args.bins bins) of the ITOF traces to save:
+args.crop  = [0,0]
+args.rebin = 'none'
+args.bins  = 2500
+
+# Rows [first, last] of the UXS camera with the spectrum, None for all:
+args.uxsrows = None
+# Floating point type of the UXS analysis ('float64' or 'float32'):
+args.uxsdtype = 'float64'
+# Weight of the newest fit in the running average the UXS fits start from,
+# None to start every fit from the moment estimates:
+args.uxswarmstart = None
 
 # Bins for pump and probe intensity out of XTCAV
 #args.minIPump = 0
@@ -1,5 +1,5 @@
 #!/bin/bash
-for ((c=$1; c<=$2; c++))
-do
-  bsub -q psanaq -n $3 -o ./Log_XTCExporter/job%J_run$1.log mpirun python XTCExporter.py exp=amolr2516:run=$c
-done
+# Exports runs $1 to $2 with $3 ranks each through the batch queue, up to $4
+# runs (default 4) at a time. Finished runs are skipped and failed runs are
+# retried, see RunBatch.py
+python RunBatch.py $1 $2 -n $3 -j ${4:-4} --launcher "bsub -K -q psanaq -n {ranks} -o ./Log_XTCExporter/job%J_run{run}.log mpirun"